@@ -0,0 +1,65 @@
+'''
+Shared setup for the benchmarks.
+The config is pointed at a scratch database and upload directory before any other
+module is imported, data.py binds the database name as default arguments at import.
+'''
+import json, os, platform, sqlite3, statistics, subprocess, sys, time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+def configure(db, pages=None):
+    from config import config
+    db = os.path.abspath(db)
+    scratch = os.path.dirname(db)
+    config['data']['db_name'] = db
+    # Upload paths are joined to the working directory, keep them relative to it
+    images = os.path.relpath(f"{scratch}/img", ROOT)
+    config['images']['dir'] = images
+    config['images']['thumb_dir'] = f"{images}/thumb"
+    config['log']['dir'] = scratch
+    if pages is not None:
+        config['cache']['pages'] = pages
+    os.makedirs(config['images']['thumb_dir'], exist_ok=True)
+    return config
+
+def summarize(samples, elapsed=None):
+    ''' Latency statistics in milliseconds for a list of durations in seconds '''
+    ordered = sorted(samples)
+    def percentile(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+    return {
+        'n': len(ordered),
+        'mean_ms': statistics.fmean(ordered) * 1000,
+        'p50_ms': percentile(0.5),
+        'p90_ms': percentile(0.9),
+        'p99_ms': percentile(0.99),
+        'max_ms': ordered[-1] * 1000,
+        'ops_per_sec': len(ordered) / (elapsed or sum(ordered)),
+    }
+
+def revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def report(name, args, results, out=None):
+    ''' Print (or write to `out`) a JSON document runs can be compared by '''
+    document = {
+        'benchmark': name,
+        'revision': revision(),
+        'created': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'args': vars(args),
+        'results': results,
+    }
+    text = json.dumps(document, indent=2)
+    if out:
+        with open(out, 'w') as f:
+            f.write(text + '\n')
+    print(text)
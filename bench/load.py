@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+'''
+In-process load test: concurrent clients drive the WSGI app with a weighted mix of
+board, thread and catalog GETs and reply POSTs against a seeded database (see seed.py).
+'''
+import argparse, io, random, threading, time, uuid
+from collections import defaultdict
+from wsgiref.util import setup_testing_defaults
+from common import configure, report, summarize
+from seed import png
+
+def environ(method, path, body=b'', content_type=None, cookie=None):
+    env = {}
+    setup_testing_defaults(env)
+    env.update({
+        'REQUEST_METHOD': method,
+        'PATH_INFO': path,
+        'REMOTE_ADDR': '127.0.0.1',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': io.BytesIO(body),
+    })
+    if content_type:
+        env['CONTENT_TYPE'] = content_type
+    if cookie:
+        env['HTTP_COOKIE'] = cookie
+    return env
+
+def multipart(fields, file=None):
+    boundary = uuid.uuid4().hex
+    body = b''.join(f'--{boundary}\r\nContent-Disposition: form-data; name="{k}"\r\n\r\n{v}\r\n'.encode()
+                    for k, v in fields.items())
+    filename, data = file or ('', b'')
+    body += (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+             f'Content-Type: application/octet-stream\r\n\r\n').encode() + data + f'\r\n--{boundary}--\r\n'.encode()
+    return body, f'multipart/form-data; boundary={boundary}'
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--db', default='/tmp/onchan-bench/onchan.db')
+    parser.add_argument('--board', default='b')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent client threads')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds to run')
+    parser.add_argument('--mix', default='board=40,thread=40,catalog=10,reply=8,image=2',
+                        help='relative weights of board, thread, catalog, reply and image reply requests')
+    parser.add_argument('--no-cache', action='store_true', help='disable the rendered page cache')
+    parser.add_argument('--out', help='also write the JSON results here')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    configure(args.db, pages=0 if args.no_cache else None)
+    import service
+    from data import reader
+    service.warm_up()
+    app = service.app
+
+    threads = [row[0] for row in reader().execute(
+        "SELECT id FROM content WHERE board = ? AND thread_id IS NULL", (f"/{args.board}/",))]
+    if not threads:
+        raise SystemExit(f"No threads on /{args.board}/, run seed.py first")
+    pages = max(1, len(threads) // 10)
+    mix = {kind: float(weight) for kind, weight in (item.split('=') for item in args.mix.split(','))}
+
+    def request(kind, rng, cookie):
+        if kind == 'board':
+            return environ('GET', f"/{args.board}/{rng.randint(1, pages)}")
+        if kind == 'thread':
+            return environ('GET', f"/{args.board}/thread/{rng.choice(threads)}")
+        if kind == 'catalog':
+            return environ('GET', f"/{args.board}/catalog")
+        fields = {'name': 'Anonymous', 'options': '', 'comment': f"load {rng.random()}"}
+        file = ('load.png', png(rng.randrange(1 << 30))) if kind == 'image' else None
+        body, content_type = multipart(fields, file)
+        return environ('POST', f"/{args.board}/thread/{rng.choice(threads)}/upload", body, content_type, cookie)
+
+    samples = defaultdict(list)
+    statuses = defaultdict(lambda: defaultdict(int))
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.duration
+
+    def client(n):
+        rng = random.Random(args.seed + n)
+        kinds, weights = list(mix), list(mix.values())
+        # Like a browser, a client keeps the deletion password cookie of its first post
+        cookie = None
+        while time.perf_counter() < deadline:
+            kind = rng.choices(kinds, weights)[0]
+            env = request(kind, rng, cookie)
+            status = []
+            headers = []
+            def start_response(s, h, exc_info=None):
+                status.append(s)
+                headers.extend(h)
+            started = time.perf_counter()
+            body = b''.join(app(env, start_response))
+            elapsed = time.perf_counter() - started
+            for name, value in headers:
+                if name == 'Set-Cookie' and cookie is None:
+                    cookie = value.split(';')[0]
+            with lock:
+                samples[kind].append(elapsed)
+                statuses[kind][status[0].split()[0]] += 1
+
+    started = time.perf_counter()
+    clients = [threading.Thread(target=client, args=(n,)) for n in range(args.clients)]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    elapsed = time.perf_counter() - started
+
+    results = {kind: dict(summarize(samples[kind], elapsed), statuses=dict(statuses[kind])) for kind in samples}
+    everything = [s for kind in samples for s in samples[kind]]
+    results['all'] = summarize(everything, elapsed)
+    report('load', args, results, args.out)
+
+if __name__ == '__main__':
+    main()
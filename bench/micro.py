@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+'''
+Micro-benchmarks of the read path against a seeded database (see seed.py):
+board index, catalog and thread queries, replies, comment markup and page renders.
+'''
+import argparse, random, time
+from common import ROOT, configure, report, summarize
+
+def measure(fn, iterations, warmup):
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--db', default='/tmp/onchan-bench/onchan.db')
+    parser.add_argument('--board', default='b')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--only', help='comma separated benchmark names')
+    parser.add_argument('--out', help='also write the JSON results here')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    configure(args.db)
+    from bottle import template
+    from data import select_threads, select_thread, select_replies, select_boards, select_board, reader
+    from data import select_board_revision, select_page_cursors
+    from markup import render_comment
+    from service import TemplateContext, get_title
+
+    random.seed(args.seed)
+    threads = [row[0] for row in reader().execute(
+        "SELECT id FROM content WHERE board = ? AND thread_id IS NULL", (f"/{args.board}/",))]
+    if not threads:
+        raise SystemExit(f"No threads on /{args.board}/, run seed.py first")
+    with open(f"{ROOT}/tests/comments.txt") as f:
+        comment = f.read()
+
+    # Pages are rendered from data loaded up front, so only the template is measured
+    boards = select_boards()
+    board = next(b for b in boards if b.path == f"/{args.board}/")
+    contexts = [TemplateContext(
+        content='html/pages/thread.html',
+        boards=boards,
+        board=board,
+        thread=select_thread(args.board, thread),
+        limit=100,
+        page_title=get_title(path=args.board, name=board.name)) for thread in random.sample(threads, min(20, len(threads)))]
+    index = TemplateContext(
+        content='html/pages/board.html',
+        boards=boards,
+        board=select_board(args.board),
+        limit=5,
+        reply=True,
+        page_title=get_title(path=args.board, name=board.name),
+        page=1)
+
+    # The deepest page that has threads on it
+    cursors = [cursor for cursor in select_page_cursors(args.board, select_board_revision(args.board)[0])
+               if select_threads(args.board, cursor, limit=1, reply_limit=0)]
+    benchmarks = {
+        'select_threads': lambda: select_threads(args.board),
+        'select_threads_last_page': lambda: select_threads(args.board, cursors[-1] if cursors else None),
+        'select_threads_catalog': lambda: select_threads(args.board, limit=board.thread_limit, reply_limit=0),
+        'select_thread': lambda: select_thread(args.board, random.choice(threads)),
+        'select_replies': lambda: select_replies(random.choice(threads)),
+        'render_comment': lambda: render_comment(comment, 1),
+        'render_thread_page': lambda: template('html/index.html', ctx=random.choice(contexts)),
+        'render_board_page': lambda: template('html/index.html', ctx=index),
+    }
+    only = args.only.split(',') if args.only else benchmarks
+    results = {name: measure(benchmarks[name], args.iterations, args.warmup) for name in only}
+    report('micro', args, results, args.out)
+
+if __name__ == '__main__':
+    main()
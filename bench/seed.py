@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+'''
+Seed a benchmark database: boards from config, then threads, replies, quotes
+and images per board through the same data functions the service uses.
+'''
+import argparse, os, random, struct, sys, zlib, hashlib, time
+from datetime import datetime, timedelta
+from common import ROOT, configure
+
+def png(seed):
+    ''' A distinct small PNG, so uploads are not deduplicated away '''
+    width, height = 64, 48
+    # The whole seed is in the pixels, no two seeds share a file
+    row = bytes([0]) + (seed.to_bytes(8, 'big') * width)[:width * 3]
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(row * height))
+            + chunk(b'IEND', b''))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--db', default='/tmp/onchan-bench/onchan.db')
+    parser.add_argument('--boards', default='b,g', help='comma separated board names from config')
+    parser.add_argument('--threads', type=int, default=100, help='threads per board')
+    parser.add_argument('--replies', type=int, default=50, help='replies per thread')
+    parser.add_argument('--quote-rate', type=float, default=0.3, help='share of replies quoting an earlier post')
+    parser.add_argument('--image-rate', type=float, default=0.2, help='share of replies with an image')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    if os.path.exists(args.db):
+        sys.exit(f"{args.db} exists, remove it first")
+    os.makedirs(os.path.dirname(os.path.abspath(args.db)), exist_ok=True)
+    config = configure(args.db)
+    import service
+    from data import Content, Image, insert_post, image_ids
+    service.bootstrap()
+
+    random.seed(args.seed)
+    with open(f"{ROOT}/tests/comments.txt") as f:
+        lines = [line.rstrip('\n') for line in f if line.strip()]
+    created = datetime.utcnow() - timedelta(days=1)
+    started = time.perf_counter()
+    posts = images = 0
+
+    def post(board, thread, subject, comment):
+        nonlocal created, posts, images
+        created += timedelta(milliseconds=100)
+        img = None
+        # Threads can't be started without an image
+        if thread is None or random.random() < args.image_rate:
+            image_id = next(image_ids)
+            data = png(image_id)
+            filename = f"{image_id}.png"
+            with open(f"{config['images']['dir']}/{filename}", 'wb') as f:
+                f.write(data)
+            img = Image(
+                filename=filename, orig_filename=f"seed{images}.png",
+                size=len(data), width=64, height=48, url=f"{config['images']['dir']}/{filename}",
+                checksum=hashlib.sha512(data).hexdigest(), version=1)
+            images += 1
+        content_id, _, _ = insert_post(Content(
+            created=created, board=f"/{board}/", thread_id=thread, name='Anonymous',
+            options='', subject=subject, comment=comment), img)
+        posts += 1
+        return content_id
+
+    for board in args.boards.split(','):
+        for t in range(args.threads):
+            thread = post(board, None, f"thread {t}", '\n'.join(random.sample(lines, 3)))
+            ids = [thread]
+            for r in range(args.replies):
+                comment = random.choice(lines)
+                if random.random() < args.quote_rate:
+                    comment = f">>{random.choice(ids)}\n{comment}"
+                ids.append(post(board, thread, None, comment))
+
+    elapsed = time.perf_counter() - started
+    print(f"Seeded {posts} posts and {images} images into {args.db} in {elapsed:.1f}s")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+import threading, gzip
+from collections import OrderedDict
+from config import config
+
+class Page:
+    ''' A rendered page, the validators of the data it was rendered from and its gzip body once needed '''
+    def __init__(self, body, etag=None, modified=None):
+        self.body = body
+        self.etag = etag
+        self.modified = modified
+        self.gzip = None
+
+    def gzipped(self):
+        # Racing threads may both compress, either result is fine to keep
+        if self.gzip is None:
+            self.gzip = gzip.compress(self.body.encode('utf-8'), config['compress']['level'])
+        return self.gzip
+
+class PageCache:
+    '''
+    LRU cache of rendered pages keyed by (route, board, page/thread).
+    Writes invalidate exactly the keys they affect, a render that raced with
+    an invalidation is dropped instead of being cached stale. Writes made by
+    other processes don't invalidate it, pages are looked up with the ETag of
+    the current revision and one rendered at an older revision is dropped.
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, etag=None):
+        ''' The cached page, a page rendered at another `etag` is stale and dropped '''
+        with self.lock:
+            page = self.pages.get(key)
+            if page is not None and etag is not None and page.etag != etag:
+                del self.pages[key]
+                page = None
+            if page is None:
+                self.misses += 1
+                return None
+            self.pages.move_to_end(key)
+            self.hits += 1
+            return page
+
+    def set(self, key, page, generation):
+        ''' Store a page rendered from data read while `generation` was current '''
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.pages[key] = page
+            self.pages.move_to_end(key)
+            while len(self.pages) > self.size:
+                self.pages.popitem(last=False)
+
+    def invalidate(self, matches):
+        ''' Drop every key `matches` accepts '''
+        with self.lock:
+            self.generation += 1
+            for key in [key for key in self.pages if matches(key)]:
+                del self.pages[key]
+
+    def invalidate_board(self, path):
+        ''' Every index page and the catalog of a board '''
+        self.invalidate(lambda key: key[0] in ('board', 'catalog') and key[1] == path)
+
+    def invalidate_thread(self, path, thread):
+        self.invalidate(lambda key: key == ('thread', path, int(thread)))
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.pages)}
+
+page_cache = PageCache(config['cache']['pages'])
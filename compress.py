@@ -0,0 +1,42 @@
+import gzip
+from functools import wraps
+from bottle import request, response
+from cache import Page
+from config import config
+
+def accepts_gzip():
+    ''' Whether Accept-Encoding allows gzip, honouring q=0. A q-value that doesn't parse counts as no gzip '''
+    for coding in request.environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        name, *params = coding.split(';')
+        if name.strip().lower() in ('gzip', 'x-gzip', '*'):
+            for param in params:
+                key, _, value = param.partition('=')
+                if key.strip().lower() == 'q':
+                    try:
+                        return float(value) > 0
+                    except ValueError:
+                        return False
+            return True
+    return False
+
+def compress_response(fn):
+    '''
+    Bottle plugin gzipping text responses of at least compress.min_size for clients that
+    accept it. A cached Page is compressed once and its gzip body reused after that.
+    '''
+    @wraps(fn)
+    def _compress_response(*args, **kwargs):
+        body = fn(*args, **kwargs)
+        page = body if isinstance(body, Page) else None
+        if page:
+            body = page.body
+        if (not isinstance(body, str) or len(body) < config['compress']['min_size']
+                or response.status_code != 200 or 'Content-Encoding' in response.headers
+                or not (response.content_type or response.default_content_type).startswith('text/')):
+            return body
+        response.set_header('Vary', 'Accept-Encoding')
+        if not accepts_gzip():
+            return body
+        response.set_header('Content-Encoding', 'gzip')
+        return page.gzipped() if page else gzip.compress(body.encode('utf-8'), config['compress']['level'])
+    return _compress_response
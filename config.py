@@ -3,18 +3,75 @@ config = {
     "branding": "onchan",
     "attribution": "Max Headroom",
     "images": {
-        "dir": "./public/img"
+        "dir": "./public/img",
+        # Largest accepted upload in bytes
+        "max_size": 5 * 1024 ** 2,
+        "thumb_dir": "./public/img/thumb",
+        # Thumbnails fit in a square of this many pixels
+        "thumb_size": 250
     },
     "data": {
         "db_name": "onchan.db",
         "migration_dir": "./sql/migration",
+        # Longest wait in seconds between purge checks while idle, deletes wake the purge at once
         "purge_delay": 30,
+        # Queued image files unlinked per purge transaction
+        "purge_batch": 100,
+        # Seconds a connection waits on a locked database before giving up
+        "busy_timeout": 5,
+        # Prepared statements kept per pooled connection
+        "cached_statements": 256,
+        # Bytes of the database file memory-mapped per connection
+        "mmap_size": 256 * 1024 * 1024,
+        # Page cache per connection, negative values are KiB
+        "cache_size": -16384,
+        # Ids a process reserves from a sequence per write
+        "id_block": 32,
+        # Seconds the writer thread waits for more writes to share a commit, and how many at most
+        "commit_window": 0,
+        "commit_batch": 64,
+    },
+    "log": {
+        "dir": ".",
+        "name": "onchan.log",
+        # Roll the log by "size" (max_bytes) or by "time" (when)
+        "rotate": "size",
+        "max_bytes": 10 * 1024 ** 2,
+        "when": "midnight",
+        "backups": 5,
+        # Records written per batch and seconds between flushes when idle
+        "batch": 256,
+        "flush_interval": 1.0,
+        # Log executed SQL statements, sampled at this rate
+        "sql_trace": False,
+        "sql_sample": 0.01
+    },
+    "metrics": {
+        # Addresses allowed to read /metrics, matched against the connecting peer.
+        # Behind a reverse proxy that is the proxy, so keep /metrics off public routes
+        "allow": ["127.0.0.1", "::1"]
+    },
+    "cache": {
+        # Rendered board, thread and catalog pages kept in memory
+        "pages": 1024
+    },
+    "compress": {
+        # Text responses smaller than this many characters are sent as they are
+        "min_size": 1024,
+        # gzip level for pages, 1 is fastest, 9 smallest
+        "level": 6
     },
     "server": {
         "debug": False,
         "reload": True,
         "port": 8080,
-        "host": "localhost"
+        "host": "localhost",
+        # Processes forked by server.py, 0 means one per core
+        "workers": 0,
+        # Request threads per worker process
+        "threads": 8,
+        # Seconds browsers may reuse /public/ assets before revalidating, uploads are cached for good
+        "static_max_age": 3600
     },
     "info": {
         "disclaimer": "Images uploaded are the responsibility of the Poster. Comments are owned by the Poster.",
@@ -61,6 +118,13 @@ Catch me schizoposting in >>>/x/.
             "Who is the queen": "Still Boxxy"
         }
     },
+    "passwords": {
+        # Processes hashing new posters' passwords, posters allowed to wait for one,
+        # and seconds a poster waits at most
+        "workers": 2,
+        "queued": 16,
+        "timeout": 10
+    },
     "cookies": {
         "key": "lolololololololololololololololololololololololololololololololololololololololololololololololol",
         "name": "onchan_pass",
@@ -1,10 +1,16 @@
-import sqlite3, os, hashlib, re
+import sqlite3, os, hashlib, re, threading, copy
 from datetime import datetime
 from config import config
+from pool import create_connection, reader, writer, group_commit
+from markup import render_comment
+
+# Timestamps are written by the sqlite3 datetime adapter or current_timestamp, both ISO 8601
+sqlite3.register_converter('DATETIME', lambda value: datetime.fromisoformat(value.decode()))
 
 class Image:
     def __init__(self,
                  id=None,
+                 created=None,
                  content_id=None,
                  filename=None,
                  orig_filename=None,
@@ -14,9 +20,12 @@ class Image:
                  url=None,
                  checksum=None,
                  version=-1,
-                 thread_id=-1):
+                 thread_id=-1,
+                 thumb_url=None,
+                 thumb_width=None,
+                 thumb_height=None):
         self.id = id
-        self.created = datetime.utcnow()
+        self.created = created or datetime.utcnow()
         self.content_id = content_id
         self.filename = filename
         self.orig_filename = orig_filename
@@ -27,29 +36,36 @@ class Image:
         self.checksum = checksum
         self.version = version
         self.thread_id = thread_id
+        self.thumb_url = thumb_url
+        self.thumb_width = thumb_width
+        self.thumb_height = thumb_height
             
 class Content:
     def __init__(self,
                  id=None,
+                 created=None,
                  board=None,
                  thread_id=None,
                  name=None,
                  subject=None,
                  comment=None, 
+                 comment_html=None,
                  options=None,
                  img=None,
                  num_replies=None,
                  num_image_replies=None,
                  replies=[],
                  sage=0,
-                 quotes=[]):
+                 quotes=[],
+                 bumped_at=None):
         self.id = id
-        self.created = datetime.utcnow()
+        self.created = created or datetime.utcnow()
         self.board = board
         self.thread_id = thread_id
         self.name = name
         self.subject = subject
         self.comment = comment
+        self.comment_html = comment_html
         self.options = options
         self.img = img
         self.replies = replies
@@ -57,6 +73,7 @@ class Content:
         self.num_image_replies = num_image_replies
         self.sage = sage
         self.quotes = quotes
+        self.bumped_at = bumped_at
         
 
 class Board:
@@ -86,201 +103,273 @@ class DeletionAuth:
         self.password_hash = password_hash
 
 def select_migration_table_exists(db_file=config['data']['db_name']):
-    conn = create_connection(db_file)
-    cur = conn.cursor()
-    cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='migration'")
+    cur = reader(db_file).execute("SELECT name FROM sqlite_master WHERE type='table' AND name='migration'")
     rows = cur.fetchall()
-    conn.close()
     if rows and rows[0][0] == 'migration':
         return True
     return False
 
-def insert_migration(name, hash, db_file=config['data']['db_name']):
-    conn = create_connection(db_file)
-    cur = conn.cursor()
-    cur.execute("INSERT INTO migration(name, hash) VALUES (?, ?)", (name, hash))
-    conn.commit()
-    conn.close()
+def _insert_migration(conn, name, hash):
+    cur = conn.execute("INSERT INTO migration(name, hash) VALUES (?, ?)", (name, hash))
     return cur.lastrowid
 
+def backfill_bumped_at(conn):
+    ''' Seed bumped_at for threads created before V002 with the order select_threads used to compute '''
+    conn.execute('''UPDATE content
+                    SET bumped_at = COALESCE(
+                        (SELECT MAX(c2.created) FROM content c2 WHERE c2.thread_id = content.id AND content.limited_at >= c2.created),
+                        content.limited_at,
+                        (SELECT MAX(c2.created) FROM content c2 WHERE c2.thread_id = content.id),
+                        content.created)
+                    WHERE thread_id IS NULL AND bumped_at IS NULL''')
+
+def backfill_comment_html(conn):
+    ''' Compile markup for comments posted before V003 '''
+    rows = conn.execute("SELECT id, thread_id, comment FROM content WHERE comment_html IS NULL").fetchall()
+    conn.executemany("UPDATE content SET comment_html = ? WHERE id = ?",
+                     [(render_comment(comment, thread_id or id), id) for id, thread_id, comment in rows])
+
+# Data that can't be derived in SQL alone, run in the same transaction as their migration
+backfills = {
+    'V002__bump_order.sql': backfill_bumped_at,
+    'V003__comment_html.sql': backfill_comment_html,
+}
+
+# Migrations run on a dedicated connection so pragmas set by the scripts
+# (foreign_keys) don't leak into the pooled connections
 def migrate(db_file=config['data']['db_name']):
-    migration_table_exists = select_migration_table_exists()
+    migration_table_exists = select_migration_table_exists(db_file)
     dir = os.fsencode(config['data']['migration_dir'])
+    applied = {}
     if migration_table_exists:
+        cur = reader(db_file).execute("SELECT name, hash FROM migration")
+        applied = dict(cur.fetchall())
+    for file in sorted(os.listdir(dir)):
+        filename = os.fsdecode(file)
+        with open(f"{dir.decode()}/{filename}") as migration_file:
+            migration = migration_file.read()
+        m = hashlib.sha512()
+        m.update(migration.encode('utf-8'))
+        if filename in applied:
+            if applied[filename] != m.hexdigest():
+                print("Migration file found with different checksum")
+                exit(1)
+            print(f"Migration {filename} already applied, skipping...")
+            continue
+        print(f"Applying {filename}...")
         conn = create_connection(db_file)
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM migration")
-        rows = cur.fetchall()
-        conn.close()
-        migration_files = os.listdir(dir)
-        file_checksums = [(f, c) for _, f, c in rows]
-        files = [f for f, _ in file_checksums]
-        for file in migration_files:
-            filename = os.fsdecode(file)
-            with open(f"{dir.decode()}/{filename}") as migration_file:
-                migration = migration_file.read()
-            m = hashlib.sha512()
-            m.update(migration.encode('utf-8'))
-            lookup = (filename, m.hexdigest())
-            if lookup not in file_checksums:
-                if lookup[1] not in [x[1] for x in file_checksums]:
-                    print("Migration file found with different checksum")
-                    exit(1)
-                print(f"Applying {filename}...")
-                conn = create_connection(db_file)
-                cur = conn.cursor()
-                cur.executescript(migration)
-                conn.commit()
-                conn.close()
-            else:
-                print(f"Migration {filename} already applied, skipping...")
-    else:
-        for file in os.listdir(dir):
-            filename = os.fsdecode(file)
-            with open(f"{dir.decode()}/{filename}") as migration_file:
-                migration = migration_file.read()
-            print(f"Applying {filename}...")
-            conn = create_connection(db_file)
-            cur = conn.cursor()
-            cur.executescript(migration)
+        try:
+            # executescript commits anything pending but doesn't open a transaction itself, so
+            # the script, its backfill and its migration row are committed together or not at all
+            conn.executescript(f"BEGIN;\n{migration}")
+            if filename in backfills:
+                print(f"Backfilling {filename}...")
+                backfills[filename](conn)
+            _insert_migration(conn, filename, m.hexdigest())
             conn.commit()
+        except:
+            conn.rollback()
+            raise
+        finally:
             conn.close()
-            m = hashlib.sha512()
-            m.update(migration.encode('utf-8'))
-            insert_migration(filename, m.hexdigest())
-
-            
 
 def insert_board(board, db_file=config['data']['db_name']):
-    conn = create_connection(db_file)
-    cur = conn.cursor()
-    cur.execute(f'''INSERT INTO board(path, name, description, thread_limit, image_limit, bump_limit)
+    with writer(db_file) as conn:
+        cur = conn.execute(f'''INSERT INTO board(path, name, description, thread_limit, image_limit, bump_limit)
                     VALUES(?, ?, ?, ?, ?, ?)''', (board.path, board.name, board.description, board.thread_limit, board.image_limit, board.bump_limit))
-    conn.commit()
-    conn.close()
+    board_registry.changed()
     return cur.lastrowid
 
-def create_connection(db_file=config['data']['db_name']):
-    conn = None
-    try:
-        conn = sqlite3.connect(db_file, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
-        conn.set_trace_callback(print)
-    except Error as e:
-        print(e)
+class Sequence:
+    '''
+    Monotonic ids from a named row of the sequence table.
+    A process reserves a block of ids in one write and hands them out under a lock,
+    blocks never overlap so workers sharing the database never collide.
+    '''
+    def __init__(self, name, block=config['data']['id_block'], db_file=config['data']['db_name']):
+        self.name = name
+        self.block = block
+        self.db_file = db_file
+        self.lock = threading.Lock()
+        self.pid = None
+        self.next_id = self.end = 0
+
+    def reserve(self):
+        with writer(self.db_file) as conn:
+            end, = conn.execute(f'''UPDATE sequence SET value = value + ? WHERE name = ? RETURNING value''',
+                                (self.block, self.name)).fetchone()
+        self.next_id, self.end = end - self.block + 1, end + 1
+
+    def __next__(self):
+        with self.lock:
+            # A forked worker must not reuse the block its parent reserved
+            if self.pid != os.getpid() or self.next_id >= self.end:
+                self.pid = os.getpid()
+                self.reserve()
+            id = self.next_id
+            self.next_id += 1
+            return id
 
-    return conn
+image_ids = Sequence('image')
 
-def insert_image(img, thread, db_file=config['data']['db_name']):
+class ImageLimitReached(Exception):
+    pass
+
+class BlobGone(Exception):
+    pass
+
+def _insert_image(conn, img, thread, image_limit=None, shared=False):
+    '''
+    For replies the image is only inserted while the thread is under `image_limit`.
+    The limit is checked in the insert itself so concurrent replies can't overshoot it.
+    A `shared` image reuses the file of an earlier upload, which must still be referenced
+    or queued for removal but not purged yet, checked in this transaction like the limit.
+    '''
+    if shared and not conn.execute(f'''SELECT EXISTS (SELECT 1 FROM blob WHERE checksum = ? AND url = ? AND refs > 0)
+                    OR (EXISTS (SELECT 1 FROM image_removal_queue WHERE path = ?)
+                        AND (? IS NULL OR EXISTS (SELECT 1 FROM image_removal_queue WHERE path = ?)))''',
+                    (img.checksum, img.url, img.url, img.thumb_url, img.thumb_url)).fetchone()[0]:
+        raise BlobGone("Shared file was purged")
+    guard = ''
+    params = ()
+    if thread and image_limit is not None:
+        guard = 'WHERE (SELECT image_replies FROM content WHERE id = ?) < ?'
+        params = (thread, image_limit)
+    cur = conn.execute(f'''INSERT INTO image(content_id, filename, orig_filename, size, width, height, checksum, version, url, thread_id,
+                    thumb_url, thumb_width, thumb_height)
+                SELECT ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ? {guard}''', (
+                        img.content_id,
+                        img.filename,
+                        img.orig_filename,
+                        img.size,
+                        img.width,
+                        img.height,
+                        img.checksum,
+                        img.version,
+                        img.url,
+                        thread,
+                        img.thumb_url,
+                        img.thumb_width,
+                        img.thumb_height) + params)
+    if not cur.rowcount:
+        raise ImageLimitReached("Image limit reached")
+    return cur.lastrowid
+
+def insert_image(img, thread, image_limit=None, shared=False, db_file=config['data']['db_name']):
     if img:
-        conn = create_connection(db_file)
-        cur = conn.cursor()
-        cur.execute(f'''INSERT INTO image(content_id, filename, orig_filename, size, width, height, checksum, version, url, thread_id)
-                    VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', (
-                            img.content_id,
-                            img.filename,
-                            img.orig_filename,
-                            img.size,
-                            img.width,
-                            img.height,
-                            img.checksum,
-                            img.version,
-                            img.url,
-                            thread))
-        conn.commit()
-        conn.close()
-        return cur.lastrowid
+        with writer(db_file) as conn:
+            return _insert_image(conn, img, thread, image_limit, shared)
     return None
 
+def select_blob(checksum, db_file=config['data']['db_name']):
+    ''' The stored file (and thumbnail) an upload with this checksum can share, if any '''
+    cur = reader(db_file).execute(f'''SELECT i.filename, i.url, i.width, i.height, i.thumb_url, i.thumb_width, i.thumb_height
+                    FROM blob b
+                    INNER JOIN image i ON i.checksum = b.checksum AND i.url = b.url
+                    WHERE b.checksum = ? AND b.refs > 0
+                    ORDER BY i.thumb_url IS NULL
+                    LIMIT 1''', (checksum,))
+    return cur.fetchone()
 
-def insert_quotes(thread_id, comment, db_file=config['data']['db_name']):
-    conn = create_connection(db_file)
-    cur = conn.cursor()
+def update_image_thumbnail(id, thumb_url, thumb_width, thumb_height, db_file=config['data']['db_name']):
+    ''' Every image sharing the file gets the thumbnail '''
+    with writer(db_file) as conn:
+        conn.execute(f'''UPDATE image SET thumb_url = ?, thumb_width = ?, thumb_height = ?
+                    WHERE (checksum, url) = (SELECT checksum, url FROM image WHERE id = ?)''',
+                     (thumb_url, thumb_width, thumb_height, id))
+
+def _insert_quotes(conn, thread_id, comment):
     quotes = set((thread_id, quote.group(1)) for quote in re.finditer(r">>(\d+)", comment, re.MULTILINE))
-    cur.executemany(f'''INSERT INTO quotes(content_id, source_id) VALUES (?, ?)''', quotes)
-    conn.commit()
-    conn.close()
+    conn.executemany(f'''INSERT INTO quotes(content_id, source_id) VALUES (?, ?)''', quotes)
+
+def insert_quotes(thread_id, comment, db_file=config['data']['db_name']):
+    with writer(db_file) as conn:
+        _insert_quotes(conn, thread_id, comment)
 
 def select_quotes(content_id, db_file=config['data']['db_name']):
-    conn = create_connection(db_file)
-    cur = conn.cursor()
-    rows = cur.execute(f'''SELECT content_id FROM quotes WHERE source_id = ?''', (content_id,))
+    cur = reader(db_file).execute(f'''SELECT content_id FROM quotes WHERE source_id = ?''', (content_id,))
     rows = cur.fetchall()
-    conn.close()
     return [i[0] for i in rows]
 
+def _insert_content(conn, content):
+    cur = conn.execute(f'''INSERT INTO content(created, board, thread_id, name, options, subject, comment, comment_html)
+               VALUES(?, ?, ?, ?, ?, ?, ?, ?)''', (
+                    content.created,
+                    content.board, 
+                    content.thread_id, 
+                    content.name,
+                    content.options,
+                    content.subject,
+                    content.comment,
+                    render_comment(content.comment, content.thread_id)))
+    # An OP only learns its own id on insert, recompile if it quotes itself
+    if content.thread_id is None and f">>{cur.lastrowid}" in content.comment:
+        conn.execute("UPDATE content SET comment_html = ? WHERE id = ?",
+                     (render_comment(content.comment, cur.lastrowid), cur.lastrowid))
+    _insert_quotes(conn, cur.lastrowid, content.comment)
+    return cur.lastrowid
+
 def insert_content(content, db_file=config['data']['db_name']):
-    conn = create_connection(db_file)
-    cur = conn.cursor()
-    cur.execute(f'''INSERT INTO content(created, board, thread_id, name, options, subject, comment)
-                   VALUES(?, ?, ?, ?, ?, ?, ?)''', (
-                        content.created,
-                        content.board, 
-                        content.thread_id, 
-                        content.name,
-                        content.options,
-                        content.subject,
-                        content.comment))
-    conn.commit()
-    conn.close()
-    insert_quotes(cur.lastrowid, content.comment)
+    with writer(db_file) as conn:
+        return _insert_content(conn, content)
+
+def _insert_deletion_auth(conn, content_id, password_hash, image_id=None):
+    cur = conn.execute(f'''INSERT INTO deletion_auth(content_id, image_id, password_hash)
+               VALUES(?, ?, ?)''', (
+                    content_id,
+                    image_id,
+                    password_hash))
     return cur.lastrowid
 
 def insert_deletion_auth(content_id, password_hash, image_id=None, db_file=config['data']['db_name']):
-    conn = create_connection(db_file)
-    cur = conn.cursor()
-    cur.execute(f'''INSERT INTO deletion_auth(content_id, image_id, password_hash)
-                   VALUES(?, ?, ?)''', (
-                        content_id,
-                        image_id,
-                        password_hash))
-    conn.commit()
-    conn.close()
-    return cur.lastrowid
+    with writer(db_file) as conn:
+        return _insert_deletion_auth(conn, content_id, password_hash, image_id)
 
-def select_images(ids, db_file=config['data']['db_name']):
-    conn = create_connection(db_file)
-    cur = conn.cursor()
-    cur.execute(f'''SELECT url FROM image WHERE id IN ({','.join(ids)})''')
-    rows = cur.fetchall()
-    conn.close()
-    return [i[0] for i in rows]
+def _insert_post(conn, content, img=None, password_hash=None, image_limit=None, shared=False):
+    image_id = auth_id = None
+    content_id = _insert_content(conn, content)
+    if img:
+        img.content_id = content_id
+        image_id = _insert_image(conn, img, content.thread_id, image_limit, shared)
+    if password_hash:
+        auth_id = _insert_deletion_auth(conn, content_id, password_hash, image_id)
+    return content_id, image_id, auth_id
+
+def insert_post(content, img=None, password_hash=None, image_limit=None, shared=False, db_file=config['data']['db_name']):
+    '''
+    Insert a whole post, its content, quotes, image and deletion auth, atomically.
+    Posts are queued to the group commit writer and share commits with concurrent ones.
+    Nothing is written when any part fails, ImageLimitReached and BlobGone included.
+    Returns (content_id, image_id, auth_id).
+    '''
+    return group_commit(_insert_post, content, img, password_hash, image_limit, shared, db_file=db_file)
+
+def _delete_posts(conn, ids, password_hash, file_only=False):
+    # Only posts whose deletion_auth matches are touched, checked per id through its primary key
+    owned = f'''SELECT content_id FROM deletion_auth WHERE content_id IN ({placeholders(ids)}) AND password_hash = ?'''
+    if file_only:
+        rows = conn.execute(f'''DELETE FROM image WHERE content_id IN ({owned})
+                    RETURNING COALESCE(thread_id, content_id)''', (*ids, password_hash)).fetchall()
+    else:
+        rows = conn.execute(f'''DELETE FROM content WHERE id IN ({owned})
+                    RETURNING COALESCE(thread_id, id)''', (*ids, password_hash)).fetchall()
+    return {row[0] for row in rows}
 
 def delete_images(ids, password_hash, db_file=config['data']['db_name']):
-    conn = create_connection(db_file)
-    cur = conn.cursor()
-    cur.execute(f'''DELETE FROM image 
-                    WHERE content_id IN ({','.join(ids)}) 
-                    AND (SELECT password_hash 
-                         FROM deletion_auth 
-                         WHERE content_id IN ({','.join(ids)})) = \'{password_hash}\'''')
-    conn.commit()
-    conn.close()
-    for url in select_images(ids):
-        if os.path.isfile(image):
-            os.remove(image)
-            print("%s purged" % image)
-        else:
-            # If it fails, inform the user.
-            print("%s file not found for removal, skipping..." % image)
-    return cur.lastrowid
+    '''
+    Delete the images of the poster's own posts among `ids` in one transaction,
+    their files are unlinked later from image_removal_queue. Returns the threads touched.
+    '''
+    return group_commit(_delete_posts, [int(id) for id in ids], password_hash, True, db_file=db_file)
 
 def delete_contents(ids, password_hash, db_file=config['data']['db_name']):
-    conn = create_connection(db_file)
-    cur = conn.cursor()
-    cur.execute(f'''DELETE FROM content 
-                    WHERE id IN ({','.join(ids)}) 
-                    AND (SELECT password_hash FROM deletion_auth WHERE content_id IN ({','.join(ids)})) = ?''', (password_hash,))
-    conn.commit()
-    conn.close()
-    return cur.lastrowid
+    ''' Like delete_images for whole posts, deleting a thread's OP deletes the thread '''
+    return group_commit(_delete_posts, [int(id) for id in ids], password_hash, db_file=db_file)
 
 def select_boards(db_file=config['data']['db_name']):
-    conn = create_connection(db_file)
-    cur = conn.cursor()
-    cur.execute(f'''SELECT * FROM board 
+    cur = reader(db_file).execute(f'''SELECT path, name, description, thread_limit, image_limit, bump_limit FROM board 
                     ORDER BY path ASC''')
     rows = cur.fetchall()
-    conn.close()
     boards = []
     for row in rows:
         (path, name, description, thread_limit, image_limit, bump_limit) = row
@@ -295,193 +384,239 @@ def select_boards(db_file=config['data']['db_name']):
         boards.append(board)
     return boards
 
-def select_board(path, page, db_file=config['data']['db_name']):
-    conn = create_connection(db_file)
-    cur = conn.cursor()
-    cur.execute(f'''SELECT * FROM board 
-                    WHERE path = ? LIMIT 1''', (f'/{path}/',))
-    rows = cur.fetchall()
-    conn.close()
-    boards = []
+class BoardRegistry:
+    '''
+    Every board of a database, loaded once and indexed by path. Boards only change
+    through insert_board, which bumps the version so the next lookup reloads them.
+    The boards are shared, don't modify them.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = 0
+        self.loaded = {}
+
+    def changed(self):
+        with self.lock:
+            self.version += 1
+
+    def load(self, db_file=config['data']['db_name']):
+        ''' (version, boards ordered by path, boards by path) '''
+        with self.lock:
+            loaded = self.loaded.get(db_file)
+            if loaded is None or loaded[0] != self.version:
+                boards = select_boards(db_file)
+                loaded = self.loaded[db_file] = (self.version, boards, {board.path: board for board in boards})
+            return loaded
+
+    def boards(self, db_file=config['data']['db_name']):
+        return self.load(db_file)[1]
+
+    def get(self, path, db_file=config['data']['db_name']):
+        return self.load(db_file)[2].get(f'/{path}/')
+
+board_registry = BoardRegistry()
+
+def select_board_settings(path, db_file=config['data']['db_name']):
+    ''' A board without its threads, from board_registry. Don't modify it. '''
+    return board_registry.get(path, db_file)
+
+def select_image_replies(path, thread, db_file=config['data']['db_name']):
+    ''' Image reply count of a thread, None if there is no such thread on the board '''
+    row = reader(db_file).execute(f'''SELECT image_replies FROM content
+                    WHERE id = ? AND board = ? AND thread_id IS NULL''', (thread, f'/{path}/')).fetchone()
+    return row[0] if row else None
+
+def select_board_revision(path, db_file=config['data']['db_name']):
+    ''' (revision, modified_at) of a board, bumped by triggers whenever any of its pages changes '''
+    return reader(db_file).execute(f'''SELECT revision, modified_at FROM board WHERE path = ?''', (f'/{path}/',)).fetchone()
+
+def select_thread_revision(path, thread, db_file=config['data']['db_name']):
+    ''' (revision, modified_at) of a thread, None if there is no such thread on the board '''
+    return reader(db_file).execute(f'''SELECT revision, modified_at FROM content
+                    WHERE id = ? AND board = ? AND thread_id IS NULL''', (thread, f'/{path}/')).fetchone()
+
+def select_board(path, after=None, limit=10, db_file=config['data']['db_name']):
+    settings = board_registry.get(path, db_file)
+    if settings is None:
+        return None
+    board = copy.copy(settings)
+    board.threads = select_threads(path, after, limit=limit, db_file=db_file)
+    return board
+
+# Explicit column lists keep row unpacking stable as the schema grows
+CONTENT_COLUMNS = '''c.id, c.created, c.board, c.thread_id, c.name, c.options, c.subject, c.comment, c.comment_html,
+                     c.replies, c.image_replies, c.sage, c.bumped_at'''
+IMAGE_COLUMNS = '''i.id, i.created, i.content_id, i.filename, i.orig_filename, i.size, i.width, i.height,
+                   i.checksum, i.thread_id, i.version, i.url, i.thumb_url, i.thumb_width, i.thumb_height'''
+
+def placeholders(values):
+    return ', '.join('?' * len(values))
+
+def content_from_row(row):
+    (id, created, board, thread_id, name, options, subject, comment, comment_html, num_replies, num_image_replies, sage, bumped_at,
+        img_id, img_created, content_id, filename, orig_filename, size, width, height, checksum, img_thread_id, version, url,
+        thumb_url, thumb_width, thumb_height) = row[:28]
+    img = Image(id=img_id,
+             content_id=content_id,
+             filename=filename,
+             orig_filename=orig_filename,
+             size=size,
+             width=width,
+             height=height,
+             url=url,
+             checksum=checksum,
+             version=version,
+             thread_id=img_thread_id,
+             thumb_url=thumb_url,
+             thumb_width=thumb_width,
+             thumb_height=thumb_height)
+    return Content(
+        id=id,
+        created=created,
+        board=board,
+        thread_id=thread_id,
+        name=name,
+        options=options,
+        subject=subject,
+        comment=comment,
+        comment_html=comment_html,
+        img=img,
+        replies=[],
+        num_replies=num_replies,
+        num_image_replies=num_image_replies,
+        sage=sage,
+        quotes=[],
+        bumped_at=bumped_at)
+
+def load_replies(conn, thread_ids, limit):
+    ''' Last `limit` replies of every thread in one query, oldest first, keyed by thread id '''
+    replies = {id: [] for id in thread_ids}
+    if not thread_ids or limit <= 0:
+        return replies
+    rows = conn.execute(f'''SELECT * FROM (
+                        SELECT {CONTENT_COLUMNS}, {IMAGE_COLUMNS},
+                            ROW_NUMBER() OVER (PARTITION BY c.thread_id ORDER BY c.created DESC, c.id DESC) AS n
+                        FROM content c
+                        LEFT JOIN image i ON c.id = i.content_id
+                        WHERE c.thread_id IN ({placeholders(thread_ids)}))
+                    WHERE n <= ?
+                    ORDER BY n DESC''', (*thread_ids, limit)).fetchall()
     for row in rows:
-        (path2, name, description, thread_limit, image_limit, bump_limit) = row
-        board = Board(
-            path=path2, 
-            name=name, 
-            description=description, 
-            threads=select_threads(path, page, limit=10),
-            thread_limit=thread_limit,
-            image_limit=image_limit,
-            bump_limit=bump_limit)
-        return board
-    return None
+        reply = content_from_row(row)
+        replies[reply.thread_id].append(reply)
+    return replies
+
+def load_quotes(conn, contents):
+    ''' Attach quoting post ids to every content in one query '''
+    by_id = {content.id: content for content in contents}
+    if not by_id:
+        return
+    ids = list(by_id)
+    rows = conn.execute(f'''SELECT source_id, content_id FROM quotes 
+                    WHERE source_id IN ({placeholders(ids)})
+                    ORDER BY source_id, content_id''', ids).fetchall()
+    for source_id, content_id in rows:
+        by_id[source_id].quotes.append(content_id)
+
+def load_threads(conn, threads, reply_limit):
+    ''' Assemble replies and quotes for a page of threads in a constant number of queries '''
+    replies = load_replies(conn, [thread.id for thread in threads], reply_limit)
+    for thread in threads:
+        thread.replies = replies[thread.id]
+    load_quotes(conn, threads + [reply for thread in threads for reply in thread.replies])
+    return threads
 
-# TODO: Optimize this nasty query. Two sorts and a double select
 # TODO: Select thread limit from DB instead of passing
 def select_replies(thread, limit=100, db_file=config['data']['db_name']):
-    conn = create_connection(db_file)
-    cur = conn.cursor()
-    cur.execute(f'''SELECT * FROM (SELECT * FROM content 
-                    LEFT JOIN image ON content.id = image.content_id 
-                    WHERE content.thread_id = ? 
-                    ORDER BY created DESC 
-                    LIMIT ?) ORDER BY created ASC''', (thread, limit))
-    rows = cur.fetchall()
-    conn.close()
-    replies = []
-    for row in rows:
-        (id, created, board, thread_id, name, options, subject, comment, _, _, _, _,
-            img_id, img_created, content_id, filename, orig_filename, size, width, height, checksum, thread_id, version, url) = row
-        img = Image(id=img_id,
-                 content_id=content_id,
-                 filename=filename,
-                 orig_filename=orig_filename,
-                 size=size,
-                 width=width,
-                 height=height,
-                 url=url,
-                 checksum=checksum,
-                 version=version)
-        quotes = select_quotes(id)
-        content = Content(
-            id=id, 
-            board=board, 
-            thread_id=thread_id, 
-            name=name, 
-            options=options, 
-            subject=subject, 
-            comment=comment, 
-            img=img,
-            quotes=quotes)
-        replies.append(content)
+    conn = reader(db_file)
+    replies = load_replies(conn, [thread], limit)[thread]
+    load_quotes(conn, replies)
     return replies
 
 def count_threads(path, db_file=config['data']['db_name']):
-    conn = create_connection(db_file)
-    cur = conn.cursor()
-    cur.execute(f'''SELECT COUNT(*) FROM content WHERE thread_id IS NULL AND board = ?''', (path,))
+    cur = reader(db_file).execute(f'''SELECT thread_count FROM board WHERE path = ?''', (path,))
     rows = cur.fetchall()
-    conn.close()
-    return rows[0][0]
+    return rows[0][0] if rows else 0
 
-def select_threads(path, page, limit=100, db_file=config['data']['db_name']):
-    conn = create_connection(db_file)
-    cur = conn.cursor()
-    cur.execute(f'''SELECT * FROM content c1
-                    LEFT JOIN image ON c1.id = image.content_id 
-                    WHERE c1.thread_id IS NULL 
-                    AND c1.board = ? 
-                    ORDER BY COALESCE(
-                        (SELECT MAX(c2.created) FROM content c2 WHERE c2.thread_id = c1.id AND c1.limited_at >= c2.created),
-                        c1.limited_at,
-                        (SELECT MAX(c2.created) FROM content c2 WHERE c2.thread_id = c1.id),
-                        c1.created) DESC
-                    LIMIT ? OFFSET ?''', (f"/{path}/", limit, (page - 1) * 10))
+def select_rolling_thread(path, db_file=config['data']['db_name']):
+    ''' The thread roll_threads_trigger will delete when the next thread is posted, if the board is full '''
+    cur = reader(db_file).execute(f'''SELECT id FROM content 
+                    WHERE board = ? 
+                    AND thread_id IS NULL 
+                    AND (SELECT thread_count >= thread_limit FROM board WHERE path = ?)
+                    ORDER BY created, id LIMIT 1''', (path, path))
     rows = cur.fetchall()
-    conn.close()
-    threads = []
-    for row in rows:
-        (id, created, board, thread_id, name, options, subject, comment, num_replies, num_image_replies, limited_at, sage,
-        img_id, img_created, content_id, filename, orig_filename, size, width, height, checksum, thread_id, version, url) = row
-        img = Image(id=img_id,
-                 content_id=content_id,
-                 filename=filename,
-                 orig_filename=orig_filename,
-                 size=size,
-                 width=width,
-                 height=height,
-                 url=url,
-                 checksum=checksum,
-                 version=version)
-        replies = select_replies(id, limit=5)
-        quotes = select_quotes(id)
-        content = Content(
-            id=id, 
-            board=board, 
-            thread_id=thread_id, 
-            name=name, 
-            options=options,
-            subject=subject, 
-            comment=comment, 
-            img=img, 
-            replies=replies,
-            num_replies=num_replies,
-            num_image_replies=num_image_replies,
-            sage=sage,
-            quotes=quotes)
-        threads.append(content)
-    return threads
+    return rows[0][0] if rows else None
+
+def select_threads(path, after=None, limit=10, reply_limit=5, db_file=config['data']['db_name']):
+    '''
+    Threads of a board in bump order. `after` is the (bumped_at, id) cursor of the last thread
+    of the previous page, so any page is an index range scan just like the first.
+    '''
+    conn = reader(db_file)
+    cursor = 'AND (c.bumped_at, c.id) < (?, ?)' if after else ''
+    rows = conn.execute(f'''SELECT {CONTENT_COLUMNS}, {IMAGE_COLUMNS} FROM content c
+                    LEFT JOIN image i ON c.id = i.content_id 
+                    WHERE c.board = ? 
+                    AND c.thread_id IS NULL 
+                    {cursor}
+                    ORDER BY c.bumped_at DESC, c.id DESC
+                    LIMIT ?''', (f"/{path}/", *(after or ()), limit)).fetchall()
+    return load_threads(conn, [content_from_row(row) for row in rows], reply_limit)
+
+page_cursors = {}
+
+def select_page_cursors(path, revision, per_page=10, db_file=config['data']['db_name']):
+    '''
+    Cursor of the last thread of every full page of a board, the cursor of page n is at n - 2.
+    Computed once per board revision, any post or delete on the board changes it.
+    '''
+    cached = page_cursors.get((db_file, path))
+    if cached is None or cached[0] != revision:
+        rows = reader(db_file).execute(f'''SELECT bumped_at, id FROM (
+                        SELECT bumped_at, id, ROW_NUMBER() OVER (ORDER BY bumped_at DESC, id DESC) AS n
+                        FROM content
+                        WHERE board = ? AND thread_id IS NULL)
+                    WHERE n % ? = 0
+                    ORDER BY n''', (f"/{path}/", per_page)).fetchall()
+        cached = page_cursors[(db_file, path)] = (revision, [tuple(row) for row in rows])
+    return cached[1]
 
 def select_thread(path, id, limit=100, db_file=config['data']['db_name']):
-    conn = create_connection(db_file)
-    cur = conn.cursor()
-    # TODO: Don't need this many conditions
-    cur.execute(f'''SELECT * FROM content 
-                    LEFT JOIN image ON content.id = image.content_id 
-                    WHERE content.thread_id IS NULL
-                    AND content.board = ?
-                    AND content.id = ? LIMIT 1''', (f"/{path}/", id))
-    rows = cur.fetchall()
-    conn.close()
-    for row in rows:
-        (id, created, board, thread_id, name, options, subject, comment, num_replies, num_image_replies, limited_at, sage,
-            img_id, img_created, content_id, filename, orig_filename, size, width, height, checksum, thread_id, version, url) = row
-        img = Image(id=img_id,
-                 content_id=content_id,
-                 filename=filename,
-                 orig_filename=orig_filename,
-                 size=size,
-                 width=width,
-                 height=height,
-                 url=url,
-                 checksum=checksum,
-                 version=version,
-                 thread_id=thread_id)
-        replies = select_replies(id, limit=limit)
-        quotes = select_quotes(id)
-        return Content(id=id, 
-                        board=board, 
-                        thread_id=thread_id, 
-                        name=name, 
-                        options=options, 
-                        subject=subject, 
-                        comment=comment, 
-                        img=img, 
-                        replies=replies,
-                        num_replies=num_replies,
-                        num_image_replies=num_image_replies,
-                        sage=sage,
-                        quotes=quotes)
+    conn = reader(db_file)
+    rows = conn.execute(f'''SELECT {CONTENT_COLUMNS}, {IMAGE_COLUMNS} FROM content c
+                    LEFT JOIN image i ON c.id = i.content_id 
+                    WHERE c.id = ?
+                    AND c.thread_id IS NULL
+                    AND c.board = ?''', (id, f"/{path}/")).fetchall()
+    if rows:
+        return load_threads(conn, [content_from_row(rows[0])], limit)[0]
+    return None
 
 def count_image_removal_queue(db_file=config['data']['db_name']):
-    conn = create_connection(db_file)
-    cur = conn.cursor()
-    cur.execute(f'''SELECT COUNT(*) FROM image_removal_queue''')
+    cur = reader(db_file).execute(f'''SELECT COUNT(*) FROM image_removal_queue''')
     rows = cur.fetchall()
-    conn.close()
     return rows[0][0]
 
-def select_image_removal_queue(db_file=config['data']['db_name']):
-    conn = create_connection(db_file)
-    cur = conn.cursor()
-    # TODO: Don't need this many conditions
-    cur.execute(f'''SELECT * FROM image_removal_queue''')
-    rows = cur.fetchall()
-    conn.close()
-    return [r[0] for r in rows]
+def purge_image_removal_queue(remove, after='', limit=config['data']['purge_batch'], db_file=config['data']['db_name']):
+    '''
+    Unlink a batch of queued files ordered after `after` through `remove(path)`, which
+    returns whether the path is gone. The batch runs under the write lock, so no upload can
+    start sharing a file between the check in _insert_image and its unlink. Only the paths
+    removed are acknowledged, the rest stay queued. Returns the paths selected.
+    '''
+    with writer(db_file) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        cur = conn.execute(f'''SELECT path FROM image_removal_queue WHERE path > ? ORDER BY path LIMIT ?''', (after, limit))
+        paths = [r[0] for r in cur.fetchall()]
+        removed = [path for path in paths if remove(path)]
+        if removed:
+            conn.execute(f'''DELETE FROM image_removal_queue WHERE path IN ({placeholders(removed)})''', removed)
+    return paths
 
-def clear_image_removal_queue(db_file=config['data']['db_name']):
-    conn = create_connection(db_file)
-    cur = conn.cursor()
+def _sage_thread(conn, id):
     # TODO: Don't need this many conditions
-    cur.execute(f'''DELETE FROM image_removal_queue''')
-    conn.commit()
-    conn.close()
+    conn.execute(f'''UPDATE content SET sage = sage + 1 WHERE id = ?''', (id,))
 
 def sage_thread(id, db_file=config['data']['db_name']):
-    conn = create_connection(db_file)
-    cur = conn.cursor()
-    # TODO: Don't need this many conditions
-    cur.execute(f'''UPDATE content SET sage = sage + 1 WHERE id = ?''', (id,))
-    conn.commit()
-    conn.close()
\ No newline at end of file
+    group_commit(_sage_thread, id, db_file=db_file)
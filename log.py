@@ -1,17 +1,115 @@
-import logging
+import logging, logging.handlers, multiprocessing, queue, random, threading, time, os, atexit
 from datetime import datetime
 from functools import wraps
 from bottle import request, response
 
 from config import config
 
+class DeferredFlush:
+    '''
+    Handlers flush after every record, the listener calls flush_batch
+    once per batch instead so a burst of requests is one write.
+    '''
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super().flush()
+
+class BatchedRotatingFileHandler(DeferredFlush, logging.handlers.RotatingFileHandler):
+    pass
+
+class BatchedTimedRotatingFileHandler(DeferredFlush, logging.handlers.TimedRotatingFileHandler):
+    pass
+
+class BatchingListener(threading.Thread):
+    ''' Drains the log queue in the background, writing and flushing records in batches '''
+    def __init__(self, records, handlers, batch, interval):
+        super().__init__(daemon=True)
+        self.records = records
+        self.handlers = handlers
+        self.batch = batch
+        self.interval = interval
+
+    def handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def run(self, *args, **kwargs):
+        while True:
+            try:
+                record = self.records.get(timeout=self.interval)
+            except queue.Empty:
+                continue
+            written = 0
+            while record is not None:
+                self.handle(record)
+                written += 1
+                if written >= self.batch:
+                    break
+                try:
+                    record = self.records.get_nowait()
+                except queue.Empty:
+                    break
+            for handler in self.handlers:
+                handler.flush_batch()
+            if record is None:
+                return
+
+    def stop(self):
+        self.records.put(None)
+        self.join()
+
+def file_handler():
+    filename = f"{config['log']['dir']}/{config['log']['name']}"
+    if config['log']['rotate'] == 'time':
+        handler = BatchedTimedRotatingFileHandler(filename,
+                                                  when=config['log']['when'],
+                                                  backupCount=config['log']['backups'],
+                                                  delay=True)
+    else:
+        handler = BatchedRotatingFileHandler(filename,
+                                             maxBytes=config['log']['max_bytes'],
+                                             backupCount=config['log']['backups'],
+                                             delay=True)
+    handler.setLevel(logging.DEBUG if config['server']['debug'] or config['log']['sql_trace'] else logging.INFO)
+    handler.setFormatter(logging.Formatter('%(msg)s'))
+    return handler
+
 logger = logging.getLogger(config['branding'])
-logger.setLevel(logging.INFO)
-file_handler = logging.FileHandler(f"{config['branding']}.log")
-formatter = logging.Formatter('%(msg)s')
-file_handler.setLevel(logging.DEBUG if config['server']['debug'] else logging.INFO)
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
+logger.setLevel(logging.DEBUG if config['server']['debug'] or config['log']['sql_trace'] else logging.INFO)
+# Shared with forked workers, records are written by the listener of the process that started it
+log_queue = multiprocessing.Queue()
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+listener = None
+listener_lock = threading.Lock()
+
+def start():
+    ''' Start the listener once, forked workers log through their parent's '''
+    global listener
+    if listener is not None:
+        return
+    with listener_lock:
+        if listener is None:
+            os.makedirs(config['log']['dir'], exist_ok=True)
+            listener = BatchingListener(log_queue, [file_handler()],
+                                        config['log']['batch'],
+                                        config['log']['flush_interval'])
+            listener.start()
+            atexit.register(stop)
+
+def stop():
+    global listener
+    with listener_lock:
+        if listener is not None:
+            listener.stop()
+            listener = None
+
+def trace_sql(statement):
+    ''' Connection trace callback, logs a sample of executed statements '''
+    if random.random() < config['log']['sql_sample']:
+        logger.debug(statement)
 
 def log_to_logger(fn):
     '''
@@ -20,14 +118,16 @@ def log_to_logger(fn):
     '''
     @wraps(fn)
     def _log_to_logger(*args, **kwargs):
+        start()
         request_time = datetime.now()
+        started = time.perf_counter()
         actual_response = fn(*args, **kwargs)
         # modify this to log exactly what you need:
-        logger.info('%s %s %s %s %s' % (request.remote_addr,
-                                        request_time,
-                                        request.method,
-                                        request.url,
-                                        response.status))
+        logger.info('%s %s %s %s %s %.2fms' % (request.remote_addr,
+                                               request_time,
+                                               request.method,
+                                               request.url,
+                                               response.status,
+                                               (time.perf_counter() - started) * 1000))
         return actual_response
     return _log_to_logger
-
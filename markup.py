@@ -0,0 +1,63 @@
+import re
+from html import escape
+from urllib.parse import urlparse
+
+# Every markup token in one alternation, scanned once per line
+TOKEN = re.compile(r"(?P<board>>>>/[a-z]{1,3}/)"
+                   r"|(?P<quote>>>(?P<id>[0-9]+))"
+                   r"|(?P<emote>:(?P<name>[a-z]+):)"
+                   r"|(?P<url>(https?):((//)|(\\\\))+([\w\d:#@%/;$()~_?\+-=\\\.&](#!)?)*)")
+GREENTEXT = re.compile(r"^>[^>]*$")
+NEWLINE = re.compile(r"\r?\n")
+EMOTES = ('k', 'o', 't')
+
+def render_token(match, op):
+    token = match.group(0)
+    if match.group('board'):
+        return f'<a href="{escape(token.replace(">", ""))}">{escape(token)}</a>'
+    if match.group('quote'):
+        id = match.group('id')
+        return f'<a href="#p{id}">{escape(token)}{" (OP)" if id == str(op) else ""}</a>'
+    if match.group('emote'):
+        if match.group('name') in EMOTES:
+            return f'<img src="/public/emote/{match.group("name")}.png" class="emote">'
+        return None
+    try:
+        urlparse(token)
+        return f'<a target="_blank" href="{escape(token)}">{escape(token)}</a>'
+    except ValueError:
+        return None
+
+def render_line(line, op=None):
+    if '>' not in line and ':' not in line:
+        return escape(line)
+    if GREENTEXT.match(line):
+        return f'<span class="greentext">{escape(line)}</span>'
+    segments = []
+    greentext = False
+    position = 0
+    def text(segment):
+        nonlocal greentext
+        if not segment:
+            return
+        if not segments and segment[0] == '>':
+            greentext = True
+        segments.append(f'<span class="greentext">{escape(segment)}</span>' if greentext else escape(segment))
+    for match in TOKEN.finditer(line):
+        text(line[position:match.start()])
+        html = render_token(match, op)
+        if html is None:
+            text(match.group(0))
+        else:
+            segments.append(html)
+        position = match.end()
+    text(line[position:])
+    return ''.join(segments)
+
+def render_comment(comment, op=None):
+    '''
+    Compile comment markup (greentext, >>quotes, >>>/board/ links, emotes and URLs)
+    into escaped HTML, one <br/> terminated line per comment line.
+    `op` is the thread id, quotes of it are marked (OP).
+    '''
+    return '\n'.join(f'{render_line(line, op)}<br/>' for line in NEWLINE.split(comment))
@@ -0,0 +1,163 @@
+import math, re, sqlite3, threading, time
+from functools import lru_cache, wraps
+from bottle import request
+
+class Histogram:
+    '''
+    Log-scaled buckets about 10% wide, enough for p50/p99 without keeping samples.
+    Quantiles are reported as the upper bound of the bucket they fall in.
+    '''
+    GROWTH = 1.1
+    SMALLEST = 1e-6
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def bucket(self, value):
+        return int(math.log(max(value, self.SMALLEST) / self.SMALLEST, self.GROWTH))
+
+    def bound(self, bucket):
+        return self.SMALLEST * self.GROWTH ** (bucket + 1)
+
+    def observe(self, value):
+        bucket = self.bucket(value)
+        with self.lock:
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    def quantile(self, q):
+        with self.lock:
+            seen = 0
+            for bucket in sorted(self.buckets):
+                seen += self.buckets[bucket]
+                if seen >= q * self.count:
+                    return min(self.bound(bucket), self.max)
+        return 0.0
+
+class Counts(Histogram):
+    ''' Exact buckets for small integers such as queries per request '''
+    def bucket(self, value):
+        return value
+
+    def bound(self, bucket):
+        return bucket
+
+histograms = {}
+counters = {}
+metrics_lock = threading.Lock()
+# Per request thread, queries issued by the request being handled
+local = threading.local()
+
+def histogram(name, kind=Histogram, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    found = histograms.get(key)
+    if found is None:
+        with metrics_lock:
+            found = histograms.setdefault(key, kind())
+    return found
+
+def increment(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        counters[key] = counters.get(key, 0) + value
+
+def timed(name):
+    ''' Decorate a function so its duration is observed in the `name` histogram '''
+    def decorator(fn):
+        @wraps(fn)
+        def _timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                histogram(name).observe(time.perf_counter() - started)
+        return _timed
+    return decorator
+
+@lru_cache(maxsize=1024)
+def fingerprint(sql):
+    ''' Collapse literals, IN lists and whitespace so every call of a query shares one name '''
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\b\d+\b', '?', sql)
+    sql = re.sub(r'\?(?:\s*,\s*\?)+', '?+', sql)
+    return ' '.join(sql.split())
+
+def record_query(sql, seconds, rows):
+    name = fingerprint(sql)
+    histogram('query_seconds', query=name).observe(seconds)
+    if rows:
+        increment('query_rows', rows, query=name)
+    local.queries = getattr(local, 'queries', 0) + 1
+
+class TimedCursor(sqlite3.Cursor):
+    ''' Observes execution time per query fingerprint and counts the rows fetched '''
+    def execute(self, sql, parameters=()):
+        self.sql = sql
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_query(sql, time.perf_counter() - started, max(self.rowcount, 0))
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            increment('query_rows', query=fingerprint(self.sql))
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = super().fetchmany(*args, **kwargs)
+        increment('query_rows', len(rows), query=fingerprint(self.sql))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        increment('query_rows', len(rows), query=fingerprint(self.sql))
+        return rows
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+def time_route(fn):
+    ''' Bottle plugin observing handler time and queries issued per route '''
+    @wraps(fn)
+    def _time_route(*args, **kwargs):
+        local.queries = 0
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            route = f"{request.method} {request.route.rule}"
+            histogram('route_seconds', route=route).observe(time.perf_counter() - started)
+            histogram('route_queries', Counts, route=route).observe(local.queries)
+    return _time_route
+
+def label(labels):
+    return ','.join(f'{k}="{v}"' for k, v in labels)
+
+def render(extra=()):
+    ''' Every metric of this process as text, one value per line '''
+    lines = []
+    with metrics_lock:
+        hists = sorted(histograms.items())
+        counts = sorted(counters.items())
+    for (name, labels), hist in hists:
+        for q in (0.5, 0.99):
+            lines.append(f'{name}{{{label(labels + (("quantile", q),))}}} {hist.quantile(q):.6g}')
+        lines.append(f'{name}_count{{{label(labels)}}} {hist.count}')
+        lines.append(f'{name}_sum{{{label(labels)}}} {hist.sum:.6g}')
+    for (name, labels), value in counts:
+        lines.append(f'{name}{{{label(labels)}}} {value}')
+    for name, value in extra:
+        lines.append(f'{name} {value}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,89 @@
+import os, secrets, string, threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from argon2 import PasswordHasher
+from config import config
+
+ALPHABET = string.ascii_lowercase + string.ascii_uppercase + string.digits + string.punctuation
+
+# One hasher per pool process, set up when the process starts
+hasher = None
+
+def start_hasher():
+    global hasher
+    hasher = PasswordHasher()
+
+def new_password_hash():
+    ''' Hash a fresh random password, runs in a pool process '''
+    password = ''.join([secrets.choice(ALPHABET) for _ in range(32)])
+    return hasher.hash(password)
+
+def ready():
+    ''' Nothing to do, submitted to start a pool process ahead of the first poster '''
+    return hasher is not None
+
+class Busy(Exception):
+    pass
+
+class PasswordPool:
+    '''
+    Argon2 is deliberately CPU and memory heavy, so new posters' passwords are hashed in
+    a few separate processes instead of on request threads. At most `workers` hashes run
+    and `queued` wait, further posters are turned away with Busy rather than piling up.
+    '''
+    def __init__(self, workers, queued, timeout):
+        self.workers = workers
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(workers + queued)
+        self.lock = threading.Lock()
+        self.executor = None
+        self.pid = None
+
+    def pool(self):
+        with self.lock:
+            # Executors don't survive a fork, every worker process gets its own
+            if self.executor is None or self.pid != os.getpid():
+                self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                    mp_context=get_context('spawn'),
+                                                    initializer=start_hasher)
+                self.pid = os.getpid()
+            return self.executor
+
+    def start(self):
+        ''' Start the pool processes now rather than inside the first new poster's request '''
+        pool = self.pool()
+        for _ in range(self.workers):
+            pool.submit(ready)
+
+    def new_password_hash(self):
+        if not self.slots.acquire(blocking=False):
+            raise Busy("Too many new posters, try again in a moment")
+        try:
+            future = self.pool().submit(new_password_hash)
+        except BrokenProcessPool:
+            self.slots.release()
+            self.reset()
+            raise Busy("Try again in a moment")
+        except:
+            self.slots.release()
+            raise
+        # A hash that outlives its request still occupies a process, its slot is
+        # only freed once it finishes so timed out hashes can't pile up
+        future.add_done_callback(lambda future: self.slots.release())
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            raise Busy("Took too long, try again in a moment")
+        except BrokenProcessPool:
+            self.reset()
+            raise Busy("Try again in a moment")
+
+    def reset(self):
+        ''' A hashing process died, start a fresh pool for the next poster '''
+        with self.lock:
+            self.executor = None
+
+passwords = PasswordPool(config['passwords']['workers'],
+                         config['passwords']['queued'],
+                         config['passwords']['timeout'])
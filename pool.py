@@ -0,0 +1,184 @@
+import sqlite3, threading, os, queue, time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from config import config
+from log import trace_sql
+from metrics import TimedConnection
+
+def create_connection(db_file=config['data']['db_name'], check_same_thread=True):
+    conn = None
+    try:
+        conn = sqlite3.connect(
+            db_file,
+            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+            timeout=config['data']['busy_timeout'],
+            cached_statements=config['data']['cached_statements'],
+            check_same_thread=check_same_thread,
+            factory=TimedConnection)
+        if config['log']['sql_trace']:
+            conn.set_trace_callback(trace_sql)
+    except sqlite3.Error as e:
+        print(e)
+
+    return conn
+
+def apply_pragmas(conn):
+    ''' Pragmas are per connection, so they are applied once when a pooled connection is opened '''
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA mmap_size = {int(config['data']['mmap_size'])}")
+    conn.execute(f"PRAGMA cache_size = {int(config['data']['cache_size'])}")
+
+class ConnectionPool:
+    '''
+    Long-lived connections to a single SQLite database.
+    Every thread gets its own read-only connection, writes go through one
+    shared connection serialized behind a lock (SQLite allows a single writer anyway).
+    '''
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.local = threading.local()
+        self.write_lock = threading.Lock()
+        self.writer = None
+        self.group_lock = threading.Lock()
+        self.group = None
+
+    def reader(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = create_connection(self.db_file)
+            apply_pragmas(conn)
+            conn.execute("PRAGMA query_only = ON")
+            self.local.conn = conn
+        return conn
+
+    @contextmanager
+    def write(self):
+        ''' Yield the writer connection, commit on success and roll back on error '''
+        with self.write_lock:
+            if self.writer is None:
+                self.writer = create_connection(self.db_file, check_same_thread=False)
+                apply_pragmas(self.writer)
+            try:
+                yield self.writer
+                self.writer.commit()
+            except:
+                self.writer.rollback()
+                raise
+
+    def group_commit(self):
+        ''' The writer thread batching this pool's queued writes, started on first use '''
+        if self.group is None:
+            with self.group_lock:
+                if self.group is None:
+                    self.group = GroupCommitWriter(self)
+                    self.group.start()
+        return self.group
+
+    def close(self):
+        with self.write_lock:
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+class GroupCommitWriter(threading.Thread):
+    '''
+    Applies queued write operations on the pool's writer connection. Everything queued
+    while a batch commits goes into the next one, so concurrent posts share one transaction
+    and one commit. Every operation runs in its own SAVEPOINT, one that fails is rolled back
+    alone and its caller gets the exception.
+    '''
+    def __init__(self, pool):
+        super().__init__(daemon=True)
+        self.pool = pool
+        self.ops = queue.Queue()
+
+    def submit(self, fn, *args, **kwargs):
+        ''' Queue fn(conn, *args, **kwargs), the Future resolves once its batch is committed '''
+        future = Future()
+        self.ops.put((fn, args, kwargs, future))
+        return future
+
+    def take(self):
+        batch = [self.ops.get()]
+        deadline = time.monotonic() + config['data']['commit_window']
+        while len(batch) < config['data']['commit_batch']:
+            timeout = deadline - time.monotonic()
+            try:
+                batch.append(self.ops.get(timeout=timeout) if timeout > 0 else self.ops.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def apply(self, batch):
+        results = []
+        with self.pool.write() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for fn, args, kwargs, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                conn.execute("SAVEPOINT op")
+                try:
+                    results.append((future, fn(conn, *args, **kwargs), None))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO op")
+                    results.append((future, None, e))
+                conn.execute("RELEASE op")
+        return results
+
+    def run(self, *args, **kwargs):
+        while True:
+            batch = self.take()
+            try:
+                results = self.apply(batch)
+            except BaseException as e:
+                # The commit itself failed, or an op raised something like SystemExit that
+                # its savepoint doesn't catch. None of the batch was written, and the thread
+                # keeps running so later callers don't wait on a dead writer forever
+                for _, _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for future, result, error in results:
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+
+pools = {}
+pools_lock = threading.Lock()
+pools_pid = os.getpid()
+
+def get_pool(db_file=config['data']['db_name']):
+    global pools_pid
+    pool = pools.get(db_file) if pools_pid == os.getpid() else None
+    if pool is None:
+        with pools_lock:
+            if pools_pid != os.getpid():
+                # Connections opened before a fork belong to the parent, never reuse them
+                pools.clear()
+                pools_pid = os.getpid()
+            pool = pools.get(db_file)
+            if pool is None:
+                pool = pools[db_file] = ConnectionPool(db_file)
+    return pool
+
+def reader(db_file=config['data']['db_name']):
+    return get_pool(db_file).reader()
+
+def writer(db_file=config['data']['db_name']):
+    return get_pool(db_file).write()
+
+def group_commit(fn, *args, db_file=config['data']['db_name'], **kwargs):
+    ''' Run fn(conn, *args, **kwargs) in the next group commit and wait for its result '''
+    return get_pool(db_file).group_commit().submit(fn, *args, **kwargs).result()
+
+def close_pools():
+    with pools_lock:
+        for pool in pools.values():
+            pool.close()
+        pools.clear()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+'''
+Pre-fork production server. The master migrates and seeds boards once, binds the
+listening socket and forks `workers` processes, each serving the app from a bounded
+pool of `threads` threads.
+'''
+import os, signal, sys, time
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, ServerHandler
+
+from config import config
+import log
+
+class SendfileHandler(ServerHandler):
+    ''' Sends file bodies, like those of serve_static, from the kernel with sendfile '''
+    def sendfile(self):
+        filelike = self.result.filelike
+        try:
+            offset = filelike.tell()
+            filelike.fileno()
+        except (AttributeError, OSError):
+            return False
+        length = self.headers.get('Content-Length')
+        if length is None:
+            return False
+        if not self.headers_sent:
+            self.send_headers()
+        self._flush()
+        self.request_handler.connection.sendfile(filelike, offset, int(length))
+        return True
+
+class QuietHandler(WSGIRequestHandler):
+    ''' Requests are already logged by the app '''
+    def log_request(self, *args, **kwargs):
+        pass
+
+    def handle(self):
+        ''' WSGIRequestHandler.handle with SendfileHandler '''
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+        if not self.parse_request():
+            return
+        handler = SendfileHandler(self.rfile, self.wfile, self.get_stderr(), self.get_environ(), multithread=False)
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+class PooledWSGIServer(WSGIServer):
+    ''' Hands every accepted connection to a fixed pool of threads '''
+    executor = None
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+def serve(server, threads):
+    ''' Worker process: warm up after the fork, then accept on the inherited socket '''
+    import service
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    service.warm_up()
+    server.set_app(service.app)
+    server.executor = ThreadPoolExecutor(max_workers=threads)
+    try:
+        server.serve_forever()
+    finally:
+        os._exit(0)
+
+def main():
+    workers = config['server']['workers'] or os.cpu_count()
+    threads = config['server']['threads']
+    import service
+    from pool import close_pools
+    service.bootstrap()
+    # SQLite connections must not cross a fork, workers open their own
+    close_pools()
+    # Workers inherit the log queue, only the master writes the file
+    log.start()
+    server = PooledWSGIServer((config['server']['host'], config['server']['port']), QuietHandler)
+    print(f"Serving on {config['server']['host']}:{config['server']['port']} with {workers} workers x {threads} threads")
+
+    children = {}
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            serve(server, threads)
+        children[pid] = time.monotonic()
+
+    stopping = False
+    def stop(*args):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                # Already exited, os.wait() reaps it
+                pass
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(workers):
+        spawn()
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        started = children.pop(pid, None)
+        if stopping or started is None:
+            continue
+        print(f"Worker {pid} exited with status {status}, restarting")
+        # Don't spin on a worker that dies at startup
+        if time.monotonic() - started < 1:
+            time.sleep(1)
+        # Stopped while sleeping, its workers are already signalled
+        if not stopping:
+            spawn()
+    server.server_close()
+    log.stop()
+    print('Bye')
+
+if __name__ == '__main__':
+    main()
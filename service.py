@@ -1,16 +1,20 @@
 #!/usr/bin/env python3
 
-import html, re, os, random, string, secrets
+import html, re, os, random, threading, copy, hashlib, calendar, mimetypes
+from datetime import datetime
 
-from bottle import Bottle, route, static_file, template, error, abort, request, response, redirect, cookie_encode, cookie_decode
-from argon2 import PasswordHasher
+from bottle import Bottle, route, static_file, template, error, abort, request, response, redirect, cookie_encode, cookie_decode, http_date, parse_date, parse_range_header
 
 from data import *
-from util import save_image, image_dimensions
+from util import save_image, image_dimensions, precompress, FileRange, PRECOMPRESS
 from log import log_to_logger
 from config import config
 from validations import *
-from tasks import BackgroundFilePurge
+from tasks import BackgroundFilePurge, ThumbnailWorker
+from cache import page_cache, Page
+from compress import compress_response
+from passwords import passwords, Busy
+import metrics
 
 class TemplateContext:
     def __init__(self,
@@ -25,24 +29,23 @@ class TemplateContext:
                 limit = -1,
                 message = None,
                 content = None,
-                nav = 'html/components/nav.html',
+                nav = None,
                 footer = 'html/components/footer.html',
                 upload = 'html/components/upload.html',
                 replies = 'html/components/replies.html',
                 content_info = 'html/components/content/content_info.html',
                 file_info = 'html/components/content/file_info.html',
                 thread_content = 'html/components/content/thread_content.html',
-                comment_line = 'html/components/content/comment_line.html',
-                page = None):  
+                page = None,
+                after = None):  
         self.board = board
-        self.boards = boards
+        self.boards = boards if boards is not None else board_registry.boards()
         self.thread = thread
         self.config = config
-        self.nav = nav
+        self.nav = nav if nav is not None else render_nav(board)
         self.footer = footer
         self.upload = upload
         self.replies = replies
-        self.comment_line = comment_line
         self.content_info = content_info
         self.file_info = file_info
         self.thread_content = thread_content
@@ -54,6 +57,8 @@ class TemplateContext:
         self.content = content
         self.error_title = error_title
         self.page = page
+        # Cursor of the next board page
+        self.after = after
 
 cookie_opts = {
     # Aylmao, 4chan keeps cookies for 1 year, we'll keep a month. 
@@ -66,12 +71,45 @@ cookie_opts = {
 
 app = Bottle()
 app.install(log_to_logger)
-
-def merge_dicts(*args):
-    result = {}
-    for dictionary in args:
-        result.update(dictionary)
-    return result
+app.install(metrics.time_route)
+app.install(compress_response)
+
+# Every page render is observed
+template = metrics.timed('template_seconds')(template)
+
+navs = {}
+
+def render_nav(board=None):
+    ''' The nav bar only changes with the boards, so it is rendered once per registry version and active board '''
+    version, boards, _ = board_registry.load()
+    key = (version, board.path if board else None)
+    nav = navs.get(key)
+    if nav is None:
+        nav = navs[key] = template('html/components/nav.html', ctx=TemplateContext(boards=boards, board=board, nav=''))
+    return nav
+
+thumbnails = None
+thumbnails_lock = threading.Lock()
+
+def thumbnail_worker():
+    ''' Threads do not survive a fork, so every process starts its own worker on first use '''
+    global thumbnails
+    with thumbnails_lock:
+        if thumbnails is None or thumbnails.pid != os.getpid():
+            thumbnails = ThumbnailWorker()
+            thumbnails.start()
+        return thumbnails
+
+purger = None
+
+def purge_worker():
+    ''' Like thumbnail_worker, one purge thread per process '''
+    global purger
+    with thumbnails_lock:
+        if purger is None or purger.pid != os.getpid():
+            purger = BackgroundFilePurge()
+            purger.start()
+        return purger
 
 def get_title(path=None, name=None, subject=None, extra=None):
     components = []
@@ -86,6 +124,74 @@ def get_title(path=None, name=None, subject=None, extra=None):
     components.append(config['branding'])
     return ' - '.join(components)
 
+def digest_templates(root='html'):
+    ''' Pages change with the templates too, so their validators include this digest '''
+    digest = hashlib.sha1()
+    for dirpath, dirnames, filenames in sorted(os.walk(root)):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            with open(os.path.join(dirpath, filename), 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+templates_digest = digest_templates()
+
+def validators(kind, key, revision):
+    ''' Weak ETag and Last-Modified epoch for a (revision, modified_at) row '''
+    number, modified_at = revision
+    modified = calendar.timegm(modified_at.timetuple()) if modified_at else None
+    return f'W/"{templates_digest}-{kind}-{key}-{number}"', modified
+
+def not_modified(etag, modified):
+    '''
+    Set the validators and Cache-Control on the response and tell whether the client's
+    copy is current. If-None-Match wins over If-Modified-Since, as in RFC 7232.
+    '''
+    response.set_header('ETag', etag)
+    response.set_header('Cache-Control', 'no-cache')
+    if modified:
+        response.set_header('Last-Modified', http_date(modified))
+    matches = request.environ.get('HTTP_IF_NONE_MATCH')
+    if matches is not None:
+        current = matches.strip() == '*' or etag in [match.strip() for match in matches.split(',')]
+    else:
+        since = request.environ.get('HTTP_IF_MODIFIED_SINCE')
+        since = parse_date(since.split(';')[0].strip()) if since else None
+        current = since is not None and modified is not None and since >= modified
+    if current:
+        response.status = 304
+    return current
+
+def format_cursor(cursor):
+    ''' A (bumped_at, id) board cursor as it appears in ?after= of next links '''
+    bumped_at, id = cursor
+    return f'{bumped_at.isoformat()}_{id}'
+
+def parse_cursor(value):
+    ''' The cursor of a next link, None if it is missing or malformed '''
+    try:
+        bumped_at, id = value.rsplit('_', 1)
+        return datetime.fromisoformat(bumped_at), int(id)
+    except (AttributeError, ValueError):
+        return None
+
+def invalidate_threads(path, threads):
+    """ Drop cached pages showing any of the threads, including their board index and catalog """
+    for thread in threads:
+        page_cache.invalidate_thread(path, thread)
+    page_cache.invalidate_board(path)
+
+def invalidate_thread(path, thread):
+    invalidate_threads(path, [thread])
+
+def poster_password_hash():
+    ''' The poster's deletion password hash from their cookie, new posters get one set '''
+    password_hash = request.get_cookie(config['cookies']['name'], secret=config['cookies']['key'])
+    if not password_hash:
+        password_hash = passwords.new_password_hash()
+        response.set_cookie(config['cookies']['name'], password_hash, secret=config['cookies']['key'], **cookie_opts)
+    return password_hash
+
 def save_comment(path, name, options, comment, password_hash=None, thread=None, subject=None):
     content = Content(
             board=f"/{path}/", 
@@ -94,11 +200,7 @@ def save_comment(path, name, options, comment, password_hash=None, thread=None,
             options=''.join(options),
             subject=subject,
             comment=comment)
-    # empty var from tuple is delayed auth_id for inserting in next line as a pair
-    content_id = insert_content(content)
-    auth_id = None
-    if password_hash:
-        auth_id = insert_deletion_auth(content_id, password_hash)
+    content_id, _, auth_id = insert_post(content, password_hash=password_hash)
     return content_id, auth_id
 
 def save_comment_and_file(path, data, name, options, comment, password_hash, thread=None, subject=None):
@@ -106,41 +208,66 @@ def save_comment_and_file(path, data, name, options, comment, password_hash, thr
         board=f"/{path}/", 
         thread_id=thread, 
         name=name, 
-        options=options,
+        options=''.join(options),
         subject=subject,
         comment=comment)
-    content_id, _ = save_comment(path, name, options, comment, thread=thread, subject=subject)
-    if data:
-        success, image_id, filename, size, digest, msg = save_image(data)
-        if not success:
-            raise Exception(msg)
-        _, ext = os.path.splitext(data.filename)
-        width, height = image_dimensions(f"{config['images']['dir']}/{filename}")
-        img = Image(
+    # The file goes to disk before the transaction, so the write lock isn't held over upload I/O
+    success, image_id, filename, size, digest, msg = save_image(data, next(image_ids))
+    if not success:
+        raise Exception(msg)
+    url = f"{config['images']['dir']}/{filename}"
+    image_limit = select_board_settings(path).image_limit if thread else None
+    def stored_as(filename, url, width, height, thumb_url=None, thumb_width=None, thumb_height=None):
+        return Image(
             id=image_id,
-            content_id=content_id,
             filename=filename,
             orig_filename=data.filename,
             size=size,
             width=width,
             height=height,
-            url=f"{config['images']['dir']}/{filename}",
+            url=url,
             checksum=digest,
             # TODO: Get latest by query
-            version=1)
-        # empty tuple val is delayed auth_id for inserting in next line as a pair
-        image_id = insert_image(img, thread)
-        auth_id = insert_deletion_auth(content_id, password_hash, image_id=image_id)
+            version=1,
+            thumb_url=thumb_url,
+            thumb_width=thumb_width,
+            thumb_height=thumb_height)
+    blob = select_blob(digest)
+    if blob and not os.path.isfile(blob[1]):
+        blob = None
+    if blob:
+        # Same content is already stored, share its file and thumbnail. The upload stays
+        # until the post is in, the shared file may have been purged in the meantime.
+        try:
+            content_id, image_id, auth_id = insert_post(content, stored_as(*blob), password_hash, image_limit, shared=True)
+        except BlobGone:
+            blob = None
+        except:
+            os.remove(url)
+            raise
+        if blob:
+            os.remove(url)
+            print("Uploaded %s is a duplicate of %s (%d bytes)." % (data.filename, blob[0], size))
+            filename, thumb_url = blob[0], blob[4]
+    if not blob:
+        width, height = image_dimensions(url)
+        try:
+            content_id, image_id, auth_id = insert_post(content, stored_as(filename, url, width, height), password_hash, image_limit)
+        except:
+            # Nothing references a file stored just for this post
+            os.remove(url)
+            raise
+        thumb_url = None
+    if thumb_url is None:
+        thumbnail_worker().submit(image_id, filename, lambda: invalidate_thread(path, thread or content_id))
     return content_id, image_id, auth_id
 
 # ERROR PAGES
 
 @app.error(404)
 def not_found(err):
-    boards = select_boards()
     ctx = TemplateContext(
         content='html/pages/error.html', 
-        boards=boards,
         page_title=get_title(extra="404: Not found"),
         error_title="Not found",
         message="Lurk moar")
@@ -150,10 +277,8 @@ def not_found(err):
 
 @app.error(400)
 def your_bad(err):
-    boards = select_boards()
     ctx = TemplateContext(
             content='html/pages/error.html', 
-            boards=boards,
             page_title=get_title(extra="400: Bad request"),
             error_title="Bad request",
             message=err if err else "Your bad, if a validation error - email me")
@@ -161,12 +286,22 @@ def your_bad(err):
         'html/index.html', 
         ctx=ctx)
 
+def server_busy(err):
+    response.status = 503
+    response.set_header('Retry-After', '1')
+    ctx = TemplateContext(
+            content='html/pages/error.html', 
+            page_title=get_title(extra="503: Service unavailable"),
+            error_title="Service unavailable",
+            message=err)
+    return template(
+        'html/index.html', 
+        ctx=ctx)
+
 @app.error(500)
 def my_bad(err):
-    boards = select_boards()
     ctx = TemplateContext(
             content='html/pages/error.html', 
-            boards=boards,
             page_title=get_title(extra="500: Internal server error"),
             error_title="Internal server error",
             message="Internal server error - email me what you were doing/inputs")
@@ -176,14 +311,81 @@ def my_bad(err):
 
 # STATIC FILES
 
+def static_response(status, headers, body=''):
+    ''' Answer through the shared response rather than a new HTTPResponse, so the access log sees the status '''
+    response.status = status
+    for name, value in headers.items():
+        response.set_header(name, value)
+    return body
+
 @app.route('/public/<filepath:path>')
 def serve_static(filepath):
     """ Serve static files/downloads (use ?download query parameter for original filename) """
-    params = merge_dicts(dict(request.forms), dict(request.query.decode()))
-    if 'download' not in params:
-        return static_file(filepath, root='./public/')
+    root = os.path.abspath('./public') + os.sep
+    filename = os.path.abspath(os.path.join(root, filepath.strip('/\\')))
+    if not filename.startswith(root) or not os.path.isfile(filename):
+        abort(404)
+    stats = os.stat(filename)
+    mimetype, _ = mimetypes.guess_type(filename)
+    mimetype = mimetype or 'application/octet-stream'
+    if mimetype.startswith('text/'):
+        mimetype += '; charset=UTF-8'
+    headers = {'Content-Type': mimetype, 'Accept-Ranges': 'bytes', 'Last-Modified': http_date(stats.st_mtime)}
+    # Uploads are named by a never reused id, so they can be cached for good
+    if filename.startswith(os.path.abspath(config['images']['dir']) + os.sep):
+        headers['Cache-Control'] = 'public, max-age=31536000, immutable'
     else:
-        return static_file(filepath, root='./public/', download=params['download'], ctx=TemplateContext())
+        headers['Cache-Control'] = f"public, max-age={config['server']['static_max_age']}"
+    # Assets with a .gz variant vary by encoding on every response, 304s and ranges included,
+    # so shared caches never hand out the wrong one
+    if filename.endswith(PRECOMPRESS):
+        headers['Vary'] = 'Accept-Encoding'
+    download = request.query.get('download')
+    if download:
+        headers['Content-Disposition'] = 'attachment; filename="%s"' % os.path.basename(download).replace('"', '')
+
+    since = request.environ.get('HTTP_IF_MODIFIED_SINCE')
+    since = parse_date(since.split(';')[0].strip()) if since else None
+    if since is not None and since >= int(stats.st_mtime):
+        return static_response(304, headers)
+
+    ranges = request.environ.get('HTTP_RANGE')
+    if ranges is None and not download and filename.endswith(PRECOMPRESS):
+        # util.precompress wrote the .gz at startup, a stale one is never served
+        compressed = filename + '.gz'
+        if 'gzip' in request.environ.get('HTTP_ACCEPT_ENCODING', '') and os.path.isfile(compressed):
+            gz_stats = os.stat(compressed)
+            if gz_stats.st_mtime >= stats.st_mtime:
+                filename, stats = compressed, gz_stats
+                headers['Content-Encoding'] = 'gzip'
+
+    offset, length, status = 0, stats.st_size, 200
+    if ranges is not None:
+        ranges = list(parse_range_header(ranges, stats.st_size))
+        if not ranges:
+            unsatisfiable = {'Content-Range': f'bytes */{stats.st_size}'}
+            if 'Vary' in headers:
+                unsatisfiable['Vary'] = headers['Vary']
+            return static_response(416, unsatisfiable)
+        offset, end = ranges[0]
+        length, status = end - offset, 206
+        headers['Content-Range'] = f'bytes {offset}-{end - 1}/{stats.st_size}'
+    headers['Content-Length'] = str(length)
+    if request.method == 'HEAD':
+        return static_response(status, headers)
+    # A file-like body goes out through the server's wsgi.file_wrapper, see server.py
+    return static_response(status, headers, FileRange(open(filename, 'rb'), offset, length))
+
+@app.route('/metrics')
+def render_metrics():
+    """ Latency histograms, query stats and cache counters of this process as text """
+    # remote_addr trusts X-Forwarded-For, which any client can set
+    if request.environ.get('REMOTE_ADDR') not in config['metrics']['allow']:
+        abort(404)
+    response.content_type = 'text/plain; charset=utf-8'
+    return metrics.render(extra=[(f'page_cache_{k}', v) for k, v in page_cache.stats().items()] + [
+        ('image_removal_backlog', purge_worker().backlog), ('image_removal_purged', purge_worker().purged),
+        ('image_removal_failed', purge_worker().failed)])
 
 ## BOARDS
 
@@ -191,18 +393,40 @@ def serve_static(filepath):
 @app.route('/<path:re:[a-z0-9]{1,3}>/<page:int>')
 def render_board_paged(path, page=1):
     """ Render board into index.html """
-    boards = select_boards()
-    board = select_board(path, page)
+    revision = select_board_revision(path)
+    if revision is None:
+        return not_found(None)
+    cursors = select_page_cursors(path, revision[0])
+    # Page n starts after the last thread of page n - 1, pages past the last one are empty
+    expected = cursors[page - 2] if 1 < page <= len(cursors) + 1 else None
+    limit = 10 if page <= len(cursors) + 1 else 0
+    # Next links carry the cursor they were rendered with, so threads bumped since don't shift the page
+    after = parse_cursor(request.query.get('after')) if page > 1 else None
+    if after is None or after == expected:
+        after, tag, key = expected, f'{path}-{page}', ('board', path, page)
+    else:
+        limit, tag, key = 10, f'{path}-{page}-{format_cursor(after)}', None
+    etag, modified = validators('board', tag, revision)
+    if not_modified(etag, modified):
+        return ''
+    cached = page_cache.get(key, etag) if key else None
+    if cached is not None:
+        return cached
+    generation = page_cache.generation
+    board = select_board(path, after, limit)
+    threads = board.threads
     ctx = TemplateContext(
             content='html/pages/board.html', 
-            boards=boards,
             board=board,
             limit=5,
             reply=True,
             page_title=get_title(path=path, name=board.name),
-            page=page)
-    resp = template('html/index.html', ctx=ctx)
-    return resp
+            page=page,
+            after=format_cursor((threads[-1].bumped_at, threads[-1].id)) if len(threads) == 10 else None)
+    page = Page(template('html/index.html', ctx=ctx), etag, modified)
+    if key:
+        page_cache.set(key, page, generation)
+    return page
 
 @app.route('/<path:re:[a-z0-9]{1,3}>')
 def render_board(path, page=1):
@@ -218,15 +442,21 @@ def delete_from_board(path, page=1):
     on = [x for x in request.forms.decode()]
     ids = [x for x in on if x.isdigit()]
     password_hash = request.get_cookie(config['cookies']['name'], secret=config['cookies']['key'])
-    if password_hash:
+    if password_hash and ids:
         if 'delete-file-only' in on:
-            delete_images(ids, password_hash)
+            threads = delete_images(ids, password_hash)
         else:
-            delete_contents(ids, password_hash)
+            threads = delete_contents(ids, password_hash)
+        if threads:
+            purge_worker().wake()
+        invalidate_threads(path, threads)
     return redirect(f"/{path}/")
 
 @app.route('/<path:re:[a-z0-9]{1,3}>/upload', method='POST')
 def upload(path):
+    valid_size, message = validate_request_size(request.content_length)
+    if not valid_size:
+        return your_bad(message)
     name = request.forms.get('name').strip()
     subject = request.forms.get('subject').strip()
     options = request.forms.get('options').strip()
@@ -234,13 +464,16 @@ def upload(path):
     data = request.files.get("file", "")
     valid_thread, message, options = validate_new_thread(name, subject, options, comment, data)   
     if valid_thread:
-        password_hash = request.get_cookie(config['cookies']['name'], secret=config['cookies']['key'])
-        if not password_hash:
-            ph = PasswordHasher()
-            password = ''.join([secrets.choice(string.ascii_lowercase + string.ascii_uppercase + string.digits + string.punctuation) for _ in range(32)])
-            password_hash = ph.hash(password)
-            response.set_cookie(config['cookies']['name'], password_hash, secret=config['cookies']['key'], **cookie_opts)
+        try:
+            password_hash = poster_password_hash()
+        except Busy as e:
+            return server_busy(str(e))
+        rolled = select_rolling_thread(f"/{path}/")
         content_id, image_id, auth_id = save_comment_and_file(path, data, name, ''.join(options), comment, password_hash, subject=subject)
+        if rolled:
+            purge_worker().wake()
+            page_cache.invalidate_thread(path, rolled)
+        page_cache.invalidate_board(path)
         if "nonoko" in options:
             print("TODO: nonoko in /board/upload")
         return redirect(f"/{path}/")
@@ -252,19 +485,29 @@ def upload(path):
 @app.route('/<path:re:[a-z0-9]{1,3}>/thread/<thread:re:[0-9]+>')
 def render_thread(path, thread):
     """ Render thread into index.html """
-    boards = select_boards()
-    board = next(filter(lambda b: f"/{path}/" == b.path, boards))
+    board = select_board_settings(path)
+    revision = select_thread_revision(path, thread) if board else None
+    if revision is None:
+        return not_found(None)
+    etag, modified = validators('thread', thread, revision)
+    if not_modified(etag, modified):
+        return ''
+    key = ('thread', path, int(thread))
+    cached = page_cache.get(key, etag)
+    if cached is not None:
+        return cached
+    generation = page_cache.generation
     thread = select_thread(path, thread, limit=100)
     if thread:
         ctx = TemplateContext(
             content='html/pages/thread.html',
-            boards=boards,
             board=board,
             thread=thread,
             limit=100,
             page_title=get_title(path=path, name=board.name, subject=thread.subject[:30]))
-        resp = template('html/index.html', ctx=ctx)
-        return resp
+        page = Page(template('html/index.html', ctx=ctx), etag, modified)
+        page_cache.set(key, page, generation)
+        return page
     else:
         return not_found(None)
 
@@ -274,38 +517,48 @@ def delete_from_thread(path, thread):
     on = [x for x in request.forms.decode()]
     ids = [x for x in on if x.isdigit()]
     password_hash = request.get_cookie(config['cookies']['name'], secret=config['cookies']['key'])
-    if password_hash:
+    if password_hash and ids:
         if 'delete-file-only' in on:
-            delete_images(ids, password_hash)
+            threads = delete_images(ids, password_hash)
         else:
-            delete_contents(ids, password_hash)
+            threads = delete_contents(ids, password_hash)
+        if threads:
+            purge_worker().wake()
+        invalidate_threads(path, threads)
     return redirect(f"/{path}/thread/{thread}") if thread not in ids else redirect(f"/{path}/")
 
 @app.route('/<path:re:[a-z0-9]{1,3}>/thread/<thread:re:[0-9]+>/upload', method='POST')
 def upload_thread(path, thread):
+    valid_size, message = validate_request_size(request.content_length)
+    if not valid_size:
+        return your_bad(message)
     name = request.forms.get('name').strip()
     options = request.forms.get('options').strip()
     comment = request.forms.get('comment').strip()
     data = request.files.get("file", "")
     valid_reply, message, options = validate_new_reply(name, options, comment, data, path, thread)
     if valid_reply:
-        password_hash = request.get_cookie(config['cookies']['name'], secret=config['cookies']['key'])
-        if not password_hash:
-            ph = PasswordHasher()
-            password = ''.join([secrets.choice(string.ascii_lowercase + string.ascii_uppercase + string.digits + string.punctuation) for _ in range(32)])
-            password_hash = ph.hash(password)
-            response.set_cookie(config['cookies']['name'], password_hash, secret=config['cookies']['key'], **cookie_opts)
+        try:
+            password_hash = poster_password_hash()
+        except Busy as e:
+            return server_busy(str(e))
         if data.filename != 'empty':
-            content_id, image_id, auth_id = save_comment_and_file(path, data, name, options, comment, password_hash, thread=thread)
+            try:
+                content_id, image_id, auth_id = save_comment_and_file(path, data, name, options, comment, password_hash, thread=thread)
+            except ImageLimitReached as e:
+                return your_bad(str(e))
         else:
             content_id, auth_id = save_comment(path, name, options, comment, thread=thread, password_hash=password_hash)
+        invalidate_thread(path, thread)
         if "nonokosage" in options:
             sage_thread(thread)
+            invalidate_thread(path, thread)
             return redirect(f"/{path}/")
         elif "nonoko" in options:
             return redirect(f"/{path}/")
         elif "sage" in options:
             sage_thread(thread)
+            invalidate_thread(path, thread)
         return redirect(f"/{path}/thread/{thread}")
     else:
         return your_bad(message)
@@ -313,29 +566,38 @@ def upload_thread(path, thread):
 @app.route('/<path:re:[a-z0-9]{1,3}>/catalog')
 def render_catalog(path):
     """ Render board catalog into index.html """
-    boards = select_boards()
-    threads = select_threads(path=path, page=1)
-    board = next(filter(lambda b: b.path == f"/{path}/", boards))
-    board.threads = threads
+    settings = select_board_settings(path)
+    revision = select_board_revision(path) if settings else None
+    if revision is None:
+        return not_found(None)
+    etag, modified = validators('catalog', path, revision)
+    if not_modified(etag, modified):
+        return ''
+    key = ('catalog', path)
+    cached = page_cache.get(key, etag)
+    if cached is not None:
+        return cached
+    generation = page_cache.generation
+    board = copy.copy(settings)
+    board.threads = select_threads(path, limit=board.thread_limit, reply_limit=0)
     ctx = TemplateContext(
         content='html/pages/catalog.html',
         config=config,
-        boards=boards,
         board=board,
         catalog=True,
         page_title=get_title(path=path, name=board.name))
-    return template(
+    page = Page(template(
         'html/index.html',  
-        ctx=ctx)
+        ctx=ctx), etag, modified)
+    page_cache.set(key, page, generation)
+    return page
 
 ## HOME
 
 @app.route('/')
 def landing():
     """ Render content into index.html """
-    boards = select_boards()
     ctx = TemplateContext(
-        boards=boards, 
         content='html/pages/home.html')
     return template('html/index.html', ctx=ctx)
 
@@ -344,72 +606,61 @@ def landing():
 @app.route('/legal')
 def legal():
     """ Render content into index.html """
-    boards = select_boards()
     ctx = TemplateContext(
         content='html/pages/legal.html',
-        boards=boards,
         page_title=get_title(extra='Legal'))
     return template('html/index.html', ctx=ctx)
 
 @app.route('/contact')
 def contact():
     """ Render content into index.html """
-    boards = select_boards()
     ctx = TemplateContext(
         content='html/pages/contact.html',
-        boards=boards,
         page_title=get_title(extra='Contact'))
     return template('html/index.html', ctx=ctx)
 
 @app.route('/feedback')
 def feedback():
     """ Render content into index.html """
-    boards = select_boards()
     ctx = TemplateContext(
         content='html/pages/feedback.html',
-        boards=boards, 
         page_title=get_title(extra='Feedback'))
     return template('html/index.html', ctx=ctx)
 
 @app.route('/about')
 def about():
     """ Render content into index.html """
-    boards = select_boards()
     ctx = TemplateContext(
         content='html/pages/about.html',
-        boards=boards, 
         page_title=get_title(extra='About'))
     return template('html/index.html', ctx=ctx)
 
 @app.route('/rules')
 def rules():
     """ Render content into index.html """
-    boards = select_boards()
     ctx = TemplateContext(
         content='html/pages/rules.html',
-        boards=boards, 
         page_title=get_title(extra='Rules'))
     return template('html/index.html', ctx=ctx)
 
 @app.route('/faq')
 def faq():
     """ Render content into index.html """
-    boards = select_boards()
     ctx = TemplateContext(
         content='html/pages/faq.html',
-        boards=boards, 
         page_title=get_title(extra='FAQ'))
     return template('html/index.html', ctx=ctx)
 
-try:
+def bootstrap():
+    ''' One-time setup before serving: migrations, precompressed assets and the boards from config '''
     print("Checking/applying DB migrations...")
     migrate()
+    precompress()
 
     # Configuration setup
     print("Reading configuration and setting up boards...")
-    boards = select_boards()
     for board in config['boards']:
-        if not select_board(board['path'].replace('/', ''), 1):
+        if not select_board_settings(board['path'].replace('/', '')):
             print(f"Creating board {board['path']}")
             b = Board(
                 board['path'], 
@@ -420,15 +671,26 @@ try:
                 board['bump_limit'])
             insert_board(b)
 
-    # t = BackgroundFilePurge()
-    # t.start()
-    app.run(
-        server='paste',
-        host=config['server']['host'], 
-        port=config['server']['port'], 
-        debug=config['server']['debug'], 
-        reloader=config['server']['reload'])
-    # t.join()
-except:
-    # t.join()
-    print('Bye')
+def warm_up():
+    '''
+    Per-process setup, run in every worker after fork. Opens this process' connections,
+    starts its background threads and reads the front pages once.
+    '''
+    thumbnail_worker()
+    purge_worker()
+    passwords.start()
+    for board in board_registry.boards():
+        select_threads(board.path.replace('/', ''))
+
+if __name__ == '__main__':
+    try:
+        bootstrap()
+        warm_up()
+        app.run(
+            server='paste',
+            host=config['server']['host'], 
+            port=config['server']['port'], 
+            debug=config['server']['debug'], 
+            reloader=config['server']['reload'])
+    except:
+        print('Bye')
@@ -0,0 +1,48 @@
+-- Denormalized bump order so board pages and the catalog are an index range scan
+ALTER TABLE content ADD COLUMN bumped_at DATETIME;
+
+CREATE INDEX IF NOT EXISTS idx_content_board_thread_id_bumped_at ON content(board, thread_id, bumped_at);
+-- Covered by the composite index above
+DROP INDEX IF EXISTS idx_content_board;
+
+-- A new thread is bumped at creation
+CREATE TRIGGER IF NOT EXISTS bump_new_thread_trigger
+	AFTER INSERT ON content
+	WHEN NEW.thread_id IS NULL
+BEGIN
+	UPDATE content
+	SET bumped_at = NEW.created
+	WHERE content.id = NEW.id;
+END;
+
+-- Replies bump the thread until replies + sage reach the bump limit
+DROP TRIGGER IF EXISTS increment_replies_trigger;
+CREATE TRIGGER IF NOT EXISTS increment_replies_trigger
+   	AFTER INSERT ON content
+   	WHEN NEW.thread_id NOT NULL
+BEGIN
+ 	UPDATE content
+	SET replies = replies + 1,
+		bumped_at = CASE
+					WHEN content.limited_at IS NULL AND replies + sage < (SELECT bump_limit FROM board WHERE path = NEW.board) - 1
+					THEN NEW.created
+					ELSE content.bumped_at
+					END,
+		limited_at = CASE
+					 WHEN content.limited_at IS NULL AND replies + sage >= (SELECT bump_limit FROM board WHERE path = NEW.board) - 1
+					 THEN current_timestamp 
+					 ELSE content.limited_at
+					 END
+	WHERE content.id = NEW.thread_id;
+END;
+
+-- A sage can push a thread over its bump limit without a reply
+CREATE TRIGGER IF NOT EXISTS limit_saged_thread_trigger
+	AFTER UPDATE OF sage ON content
+	WHEN NEW.limited_at IS NULL
+	AND NEW.replies + NEW.sage >= (SELECT bump_limit FROM board WHERE path = NEW.board)
+BEGIN
+	UPDATE content
+	SET limited_at = current_timestamp
+	WHERE content.id = NEW.id;
+END;
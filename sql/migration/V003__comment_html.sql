@@ -0,0 +1,2 @@
+-- Comment markup compiled to HTML once at post time (see markup.py)
+ALTER TABLE content ADD COLUMN comment_html TEXT;
@@ -0,0 +1,11 @@
+-- Size-bounded thumbnails, filled in by the thumbnail worker after upload
+ALTER TABLE image ADD COLUMN thumb_url TEXT;
+ALTER TABLE image ADD COLUMN thumb_width INTEGER;
+ALTER TABLE image ADD COLUMN thumb_height INTEGER;
+
+CREATE TRIGGER IF NOT EXISTS queue_thumbnail_removal_trigger
+	AFTER DELETE ON image
+	WHEN OLD.thumb_url IS NOT NULL
+BEGIN
+	INSERT OR IGNORE INTO image_removal_queue(path) VALUES (OLD.thumb_url);
+END;
@@ -0,0 +1,49 @@
+-- Files on disk are shared by every image with the same checksum and counted here
+CREATE TABLE IF NOT EXISTS blob(
+	checksum text PRIMARY KEY NOT NULL,
+	url text NOT NULL,
+	refs INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS idx_image_checksum_url ON image(checksum, url);
+
+-- Existing uploads, duplicates stored under another url keep their own file
+INSERT OR IGNORE INTO blob(checksum, url, refs)
+SELECT checksum, url, COUNT(*)
+FROM image
+GROUP BY checksum, url;
+
+CREATE TRIGGER IF NOT EXISTS reference_blob_trigger
+	AFTER INSERT ON image
+BEGIN
+	INSERT OR IGNORE INTO blob(checksum, url) VALUES (NEW.checksum, NEW.url);
+	UPDATE blob
+	SET refs = refs + 1
+	WHERE checksum = NEW.checksum AND url = NEW.url;
+	-- Reposted before the purge got to it
+	DELETE FROM image_removal_queue WHERE path IN (NEW.url, NEW.thumb_url);
+END;
+
+-- Maintain counts for image replies and release blobs
+DROP TRIGGER IF EXISTS queue_thumbnail_removal_trigger;
+DROP TRIGGER IF EXISTS decrement_image_replies_trigger;
+CREATE TRIGGER IF NOT EXISTS decrement_image_replies_trigger
+	AFTER DELETE ON image
+BEGIN
+	UPDATE content 
+	SET image_replies = image_replies - 1
+	WHERE content.id = OLD.thread_id;
+	UPDATE blob
+	SET refs = refs - 1
+	WHERE checksum = OLD.checksum AND url = OLD.url;
+	-- Insertion to image_removal_queue happens once the last reference to a file is gone
+	INSERT OR IGNORE INTO image_removal_queue(path)
+	SELECT OLD.url
+	WHERE NOT EXISTS (SELECT 1 FROM blob WHERE checksum = OLD.checksum AND url = OLD.url AND refs > 0);
+	INSERT OR IGNORE INTO image_removal_queue(path)
+	SELECT OLD.thumb_url
+	WHERE OLD.thumb_url IS NOT NULL
+	AND NOT EXISTS (SELECT 1 FROM blob WHERE checksum = OLD.checksum AND url = OLD.url AND refs > 0);
+	DELETE FROM blob
+	WHERE checksum = OLD.checksum AND refs <= 0;
+END;
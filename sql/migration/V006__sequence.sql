@@ -0,0 +1,9 @@
+-- Named counters, processes reserve blocks of ids by bumping value
+CREATE TABLE IF NOT EXISTS sequence(
+	name text PRIMARY KEY NOT NULL,
+	value INTEGER NOT NULL
+);
+
+-- Image files used to be named by upload timestamp, continue past any of them
+INSERT OR IGNORE INTO sequence(name, value)
+SELECT 'image', MAX(IFNULL((SELECT MAX(CAST(filename AS INTEGER)) FROM image), 0), CAST(strftime('%s', 'now') AS INTEGER));
@@ -0,0 +1,17 @@
+-- Deletes and the pruning trigger look images up by their post
+CREATE INDEX IF NOT EXISTS idx_image_content_id ON image(content_id);
+
+-- Remove image, deletion_auth and quotes for any deleted post, with or without an image
+DROP TRIGGER IF EXISTS prune_content_image_and_auth_trigger;
+CREATE TRIGGER IF NOT EXISTS prune_content_image_and_auth_trigger
+	AFTER DELETE ON content
+BEGIN
+	DELETE FROM image WHERE content_id = OLD.id;
+	DELETE FROM deletion_auth WHERE content_id = OLD.id;
+	DELETE FROM quotes WHERE content_id = OLD.id;
+	DELETE FROM quotes WHERE source_id = OLD.id;
+END;
+
+-- Left behind by text replies deleted before this migration
+DELETE FROM deletion_auth WHERE content_id NOT IN (SELECT id FROM content);
+DELETE FROM quotes WHERE content_id NOT IN (SELECT id FROM content) OR source_id NOT IN (SELECT id FROM content);
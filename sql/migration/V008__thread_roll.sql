@@ -0,0 +1,53 @@
+-- Threads per board kept by triggers, so rolling doesn't count the board on every new thread
+ALTER TABLE board ADD COLUMN thread_count INTEGER NOT NULL DEFAULT 0;
+
+UPDATE board
+SET thread_count = (SELECT COUNT(*) FROM content WHERE content.board = board.path AND thread_id IS NULL);
+
+-- Oldest thread of a board is the first entry of its OPs
+CREATE INDEX IF NOT EXISTS idx_content_board_thread_id_created ON content(board, thread_id, created);
+
+CREATE TRIGGER IF NOT EXISTS count_new_thread_trigger
+	AFTER INSERT ON content
+	WHEN NEW.thread_id IS NULL
+BEGIN
+	UPDATE board SET thread_count = thread_count + 1 WHERE path = NEW.board;
+END;
+
+CREATE TRIGGER IF NOT EXISTS count_deleted_thread_trigger
+	AFTER DELETE ON content
+	WHEN OLD.thread_id IS NULL
+BEGIN
+	UPDATE board SET thread_count = thread_count - 1 WHERE path = OLD.board;
+END;
+
+-- Roll exactly the oldest thread, by id, once the board is full
+DROP TRIGGER IF EXISTS roll_threads_trigger;
+CREATE TRIGGER IF NOT EXISTS roll_threads_trigger
+	BEFORE INSERT ON content
+	WHEN NEW.thread_id IS NULL
+	AND (SELECT thread_count >= thread_limit FROM board WHERE path = NEW.board)
+BEGIN
+	DELETE FROM content
+	WHERE id = (SELECT id
+				FROM content
+				WHERE board = NEW.board
+				AND thread_id IS NULL
+				ORDER BY created, id
+				LIMIT 1);
+END;
+
+-- Remove a thread's replies with one statement per table, so the per-reply
+-- prune trigger finds nothing left to do. Image rows still go one by one
+-- through decrement_image_replies_trigger, which queues their files for purging.
+DROP TRIGGER IF EXISTS prune_children_trigger;
+CREATE TRIGGER IF NOT EXISTS prune_children_trigger
+	AFTER DELETE ON content
+	WHEN OLD.thread_id IS NULL
+BEGIN
+	DELETE FROM image WHERE thread_id = OLD.id;
+	DELETE FROM deletion_auth WHERE content_id IN (SELECT id FROM content WHERE thread_id = OLD.id);
+	DELETE FROM quotes WHERE content_id IN (SELECT id FROM content WHERE thread_id = OLD.id);
+	DELETE FROM quotes WHERE source_id IN (SELECT id FROM content WHERE thread_id = OLD.id);
+	DELETE FROM content WHERE thread_id = OLD.id;
+END;
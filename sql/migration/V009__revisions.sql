@@ -0,0 +1,87 @@
+-- Revision counters and modification times of every board and thread, for conditional GETs.
+-- Anything shown on a thread or board page bumps both, so a page is unchanged while they are.
+ALTER TABLE board ADD COLUMN revision INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE board ADD COLUMN modified_at DATETIME;
+ALTER TABLE content ADD COLUMN revision INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE content ADD COLUMN modified_at DATETIME;
+
+UPDATE board SET modified_at = current_timestamp;
+UPDATE content SET modified_at = current_timestamp WHERE thread_id IS NULL;
+
+CREATE TRIGGER IF NOT EXISTS revise_new_content_trigger
+	AFTER INSERT ON content
+BEGIN
+	UPDATE content
+	SET revision = revision + 1, modified_at = current_timestamp
+	WHERE id = COALESCE(NEW.thread_id, NEW.id);
+	UPDATE board
+	SET revision = revision + 1, modified_at = current_timestamp
+	WHERE path = NEW.board;
+END;
+
+CREATE TRIGGER IF NOT EXISTS revise_deleted_content_trigger
+	AFTER DELETE ON content
+BEGIN
+	UPDATE content
+	SET revision = revision + 1, modified_at = current_timestamp
+	WHERE id = OLD.thread_id;
+	UPDATE board
+	SET revision = revision + 1, modified_at = current_timestamp
+	WHERE path = OLD.board;
+END;
+
+CREATE TRIGGER IF NOT EXISTS revise_new_image_trigger
+	AFTER INSERT ON image
+BEGIN
+	UPDATE content
+	SET revision = revision + 1, modified_at = current_timestamp
+	WHERE id = COALESCE(NEW.thread_id, NEW.content_id);
+	UPDATE board
+	SET revision = revision + 1, modified_at = current_timestamp
+	WHERE path = (SELECT board FROM content WHERE id = NEW.content_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS revise_deleted_image_trigger
+	AFTER DELETE ON image
+BEGIN
+	UPDATE content
+	SET revision = revision + 1, modified_at = current_timestamp
+	WHERE id = COALESCE(OLD.thread_id, OLD.content_id);
+	UPDATE board
+	SET revision = revision + 1, modified_at = current_timestamp
+	WHERE path = (SELECT board FROM content WHERE id = OLD.content_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS revise_thumbnail_trigger
+	AFTER UPDATE OF thumb_url ON image
+BEGIN
+	UPDATE content
+	SET revision = revision + 1, modified_at = current_timestamp
+	WHERE id = COALESCE(NEW.thread_id, NEW.content_id);
+	UPDATE board
+	SET revision = revision + 1, modified_at = current_timestamp
+	WHERE path = (SELECT board FROM content WHERE id = NEW.content_id);
+END;
+
+-- A quote shows up as a backlink on the quoted post, which can be in another thread or board
+CREATE TRIGGER IF NOT EXISTS revise_quoted_thread_trigger
+	AFTER INSERT ON quotes
+BEGIN
+	UPDATE content
+	SET revision = revision + 1, modified_at = current_timestamp
+	WHERE id = (SELECT COALESCE(thread_id, id) FROM content WHERE id = NEW.source_id);
+	UPDATE board
+	SET revision = revision + 1, modified_at = current_timestamp
+	WHERE path = (SELECT board FROM content WHERE id = NEW.source_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS revise_unquoted_thread_trigger
+	AFTER DELETE ON quotes
+BEGIN
+	UPDATE content
+	SET revision = revision + 1, modified_at = current_timestamp
+	WHERE id = (SELECT COALESCE(thread_id, id) FROM content WHERE id = OLD.source_id);
+	UPDATE board
+	SET revision = revision + 1, modified_at = current_timestamp
+	WHERE path = (SELECT board FROM content WHERE id = OLD.source_id);
+END;
@@ -1,18 +1,86 @@
-import threading, time, os
-from data import count_image_removal_queue, select_image_removal_queue, clear_image_removal_queue
+import threading, time, os, queue
+from data import count_image_removal_queue, purge_image_removal_queue, update_image_thumbnail
+from util import make_thumbnail
 from config import config
 
 class BackgroundFilePurge(threading.Thread):
-    def run(self,*args,**kwargs):
+    '''
+    Unlinks files of deleted images queued in image_removal_queue, a batch at a time.
+    Deletes wake it, otherwise it checks back less and less often while the queue stays empty.
+    '''
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.pid = os.getpid()
+        self.wanted = threading.Event()
+        # Paths left in the queue as of the last batch, for /metrics
+        self.backlog = 0
+        self.purged = 0
+        self.failed = 0
+
+    def wake(self):
+        self.wanted.set()
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            print("%s file not found for removal, skipping..." % path)
+        except OSError as e:
+            # Stays queued, the next drain tries again
+            print("%s could not be removed: %s" % (path, e))
+            self.failed += 1
+            return False
+        self.purged += 1
+        return True
+
+    def purge(self, after=''):
+        ''' Remove one batch queued after `after`, returns the paths selected '''
+        return purge_image_removal_queue(self.remove, after)
+
+    def drain(self):
+        ''' Purge batches until the queue counted at the start is done, returns the files purged '''
+        self.backlog = count_image_removal_queue()
+        purged = self.purged
+        after = ''
+        while self.backlog > 0:
+            paths = self.purge(after)
+            self.backlog = 0 if len(paths) < config['data']['purge_batch'] else max(self.backlog - len(paths), 0)
+            if paths:
+                after = paths[-1]
+        return self.purged - purged
+
+    def run(self, *args, **kwargs):
+        delay = 1
+        while True:
+            # Rows can also be queued by other processes, so an idle wait still times out
+            self.wanted.wait(delay)
+            self.wanted.clear()
+            try:
+                purged = self.drain()
+            except Exception as e:
+                print("Purge failed: %s" % e)
+                purged = 0
+            delay = 1 if purged else min(delay * 2, config['data']['purge_delay'])
+
+class ThumbnailWorker(threading.Thread):
+    ''' Builds thumbnails for uploaded images off the request thread '''
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.pid = os.getpid()
+        self.jobs = queue.Queue()
+
+    def submit(self, image_id, filename, done=None):
+        ''' Queue a thumbnail for image_id, `done` is called once it is stored '''
+        self.jobs.put((image_id, filename, done))
+
+    def run(self, *args, **kwargs):
         while True:
-            if count_image_removal_queue() > 0:
-                images = select_image_removal_queue()
-                for image in images:
-                    if os.path.isfile(image):
-                        os.remove(image)
-                        print("%s purged" % image)
-                    else:
-                        # If it fails, inform the user.
-                        print("%s file not found for removal, skipping..." % image)
-                clear_image_removal_queue()
-            time.sleep(config['data']['purge_delay'])
+            image_id, filename, done = self.jobs.get()
+            try:
+                thumbnail = make_thumbnail(filename)
+                if thumbnail:
+                    update_image_thumbnail(image_id, *thumbnail)
+                    if done:
+                        done()
+            except Exception as e:
+                print("Thumbnail for %s failed: %s" % (filename, e))
@@ -1,6 +1,26 @@
-import os, random, hashlib, struct, imghdr, calendar
-from datetime import datetime
+import os, random, hashlib, struct, imghdr, tempfile, gzip
 from config import config
+from metrics import timed
+
+# Thumbnails are optional, without Pillow pages fall back to the full image
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+
+# Uploads are copied to disk this many bytes at a time
+CHUNK_SIZE = 64 * 1024
+
+# mkstemp creates files owner-only, files renamed into public/ get the mode open() would
+# have given them so a front proxy can serve them too. Read once, os.umask can only be read by setting it
+UMASK = os.umask(0)
+os.umask(UMASK)
+FILE_MODE = 0o666 & ~UMASK
+
+def publish(temp_file, target):
+    ''' Move a finished temporary file into place with the usual file mode '''
+    os.chmod(temp_file, FILE_MODE)
+    os.replace(temp_file, target)
 
 def image_dimensions(fname):
     '''Determine the image type of fhandle and return its size.
@@ -40,6 +60,30 @@ def image_dimensions(fname):
             return
         return width, height
 
+def make_thumbnail(filename, size=config['images']['thumb_size']):
+    ''' Write a thumbnail bounded by size x size for an uploaded image, returns (url, width, height) '''
+    if PILImage is None:
+        return None
+    source = f"{config['images']['dir']}/{filename}"
+    with PILImage.open(source) as img:
+        if img.width <= size and img.height <= size:
+            # Already small enough to be its own thumbnail
+            return None
+        img.thumbnail((size, size))
+        # Keep transparency in PNG, everything else is smaller as JPEG
+        if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+            ext, format = 'png', 'PNG'
+        else:
+            ext, format = 'jpg', 'JPEG'
+            img = img.convert('RGB')
+        stem, _ = os.path.splitext(filename)
+        thumb_dir = config['images']['thumb_dir']
+        if not os.path.exists(thumb_dir):
+            os.makedirs(thumb_dir)
+        url = f"{thumb_dir}/{stem}s.{ext}"
+        img.save(url, format)
+        return url, img.width, img.height
+
 def convert_unit(size_in_bytes):
     if not size_in_bytes:
         return None
@@ -53,34 +97,112 @@ def convert_unit(size_in_bytes):
         return '{} {}'.format(round(size_in_bytes, 1), 'B')
 
 # TODO: Cleanup this nightmare. Some validations occur in service.py now
-def save_image(data):
+@timed('save_image_seconds')
+def save_image(data, image_id):
+    '''
+    Stream an upload to disk in fixed-size chunks, hashing and measuring it in the same pass.
+    The file is written to a temporary name and renamed into place as `image_id`.
+    '''
     if data and data.file:
         _, ext = os.path.splitext(data.filename)
         if ext.lower() not in ('.bmp', '.png', '.jpg', '.jpeg', '.gif', '.tiff', '.webm'):
-            return False, None, None, None, "File extension not allowed."
-        data.file.seek(0, os.SEEK_END)
-        size = data.file.tell()
-        if size > 10e6: # 10 MB limit
-            return False, None, None, None, "File larger than 5 MB"
-        data.file.seek(0, os.SEEK_SET)
+            return False, None, None, None, None, "File extension not allowed."
         # TODO: Verify image headers, check for steganography
-        raw = data.file.read() # This is dangerous for big files
-        data.file.close()
         filename = data.filename
         save_path = f"{os.getcwd()}/{config['images']['dir']}"
-        # TODO: Use sequence in table that wraps at 8 digits
-        image_id = calendar.timegm(datetime.utcnow().timetuple())
         saved_filename = f"{str(image_id)}{ext}"
         save_file = f"{save_path}/{saved_filename}"
         if not os.path.exists(save_path):
             os.makedirs(save_path)
-        with open(save_file, "wb") as file:
-            if type(raw) == bytes: 
-                file.write(raw)
-            # Hm, will we support pgm?
-            elif type(raw) == str: 
-                file.write(raw.encode("utf-8"))
-            m = hashlib.sha512()
-            m.update(raw)
-            print("Uploaded %s to %s (%d bytes)." % (filename, save_file, len(raw)))
-        return True, image_id, saved_filename, size, m.hexdigest(), "Uploaded %s to %s (%d bytes)." % (filename, save_file, len(raw))
\ No newline at end of file
+        m = hashlib.sha512()
+        size = 0
+        too_large = False
+        data.file.seek(0, os.SEEK_SET)
+        fd, temp_file = tempfile.mkstemp(dir=save_path, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                while True:
+                    chunk = data.file.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    # Hm, will we support pgm?
+                    if type(chunk) == str:
+                        chunk = chunk.encode("utf-8")
+                    size += len(chunk)
+                    if size > config['images']['max_size']:
+                        # Abort mid-stream, the rest of the upload is never copied
+                        too_large = True
+                        break
+                    m.update(chunk)
+                    file.write(chunk)
+            if too_large:
+                os.remove(temp_file)
+                return False, None, None, None, None, "File larger than %s limit" % convert_unit(config['images']['max_size'])
+            publish(temp_file, save_file)
+        except:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            raise
+        finally:
+            data.file.close()
+        print("Uploaded %s to %s (%d bytes)." % (filename, save_file, size))
+        return True, image_id, saved_filename, size, m.hexdigest(), "Uploaded %s to %s (%d bytes)." % (filename, save_file, size)
+    return False, None, None, None, None, "No file uploaded."
+
+class FileRange:
+    '''
+    `length` bytes of an open file from `offset`. Reads stop at the end of the range,
+    and fileno/tell let a server send it with sendfile instead of reading it in Python.
+    '''
+    def __init__(self, file, offset, length):
+        self.file = file
+        self.offset = offset
+        self.remaining = length
+        file.seek(offset)
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def tell(self):
+        return self.file.tell()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self.file.seek(offset, whence)
+
+    def close(self):
+        self.file.close()
+
+# Static assets worth gzipping ahead of time, uploads are already compressed
+PRECOMPRESS = ('.css', '.js', '.txt', '.svg', '.html', '.webmanifest')
+
+def precompress(root='./public', skip=(config['images']['dir'],)):
+    ''' Write a .gz next to every text asset under `root` that lacks a current one '''
+    skip = [os.path.abspath(path) for path in skip]
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [name for name in dirnames if os.path.abspath(os.path.join(dirpath, name)) not in skip]
+        for name in filenames:
+            if not name.endswith(PRECOMPRESS):
+                continue
+            source = os.path.join(dirpath, name)
+            target = source + '.gz'
+            if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(source):
+                # Left owner-only by earlier versions, which wrote them straight from mkstemp
+                if os.stat(target).st_mode & 0o777 == 0o600 != FILE_MODE:
+                    os.chmod(target, FILE_MODE)
+                continue
+            with open(source, 'rb') as f:
+                data = f.read()
+            compressed = gzip.compress(data, compresslevel=9, mtime=0)
+            if len(compressed) >= len(data):
+                continue
+            fd, temp_file = tempfile.mkstemp(dir=dirpath, suffix='.part')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(compressed)
+            publish(temp_file, target)
@@ -1,5 +1,10 @@
 import os
-from data import select_board, select_thread
+from data import select_board_settings, select_image_replies
+from config import config
+from util import convert_unit
+
+# Room left for the text fields and multipart framing around the file
+FORM_OVERHEAD = 64 * 1024
 
 # VALIDATIONS
 
@@ -19,12 +24,18 @@ def validate_file(data):
             data.file.seek(0, os.SEEK_SET)
             if size <= 0:
                 messages.append("empty file found")
-            elif size >= 1024 ** 2 * 5:
-                messages.append("file larger than 5 MB limit")
+            elif size > config['images']['max_size']:
+                messages.append(f"file larger than {convert_unit(config['images']['max_size'])} limit")
     else:
         messages.append("image required")
     return True if len(messages) == 0 else False, messages
 
+def validate_request_size(content_length):
+    ''' Reject oversized posts from the Content-Length header, before the body is parsed '''
+    if content_length > config['images']['max_size'] + FORM_OVERHEAD:
+        return False, f"file larger than {convert_unit(config['images']['max_size'])} limit"
+    return True, None
+
 def validate_options(options):
     messages = []
     options = options.split(" ")
@@ -71,11 +82,13 @@ def validate_new_thread(name, subject, options, comment, data):
 
 def validate_new_reply(name, options, comment, data, path, thread):
     # TODO: length of name, subject, options
+    board = select_board_settings(path)
+    image_replies = select_image_replies(path, thread)
+    if board is None or image_replies is None:
+        return False, "Thread not found", options
     if data.filename != 'empty':
-        board = select_board(f"{path}", 1)
-        content = select_thread(path, thread, limit=100)
-
-        if content.num_image_replies < board.image_limit:
+        # Checked again when the image is inserted, replies posted meanwhile may reach the limit first
+        if image_replies < board.image_limit:
             valid_file, file_messages = validate_file(data)
         else:
             valid_file, file_messages = False, ["Image limit reached"]
@@ -0,0 +1,7 @@
+'''
+WSGI entry point, importing it has no side effects.
+Run `service.bootstrap()` once (server.py does) before serving from another WSGI server.
+'''
+from service import app, warm_up
+
+application = app